@@ -0,0 +1,160 @@
+"""Compares how many concurrent requests waitress and the async serving mode can handle when upstream is slow
+
+Both servers run in their own process, against the local stand-ins from tests/fakes.py.
+The safetensors are already in our fake R2, so every request is a metadata miss which waits on
+the slow CivitAI and R2, but none of them need a conversion.
+Each concurrency level uses new model ids, so that no level is helped by the caches of the one before.
+The client, the stand-ins and the server share the CPUs of this machine, so on a small one the stand-ins
+themselves become slow under load. The stage timings on /metrics show how long upstream really took.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# We're a single client sending far more than any real one would, so the rate limits are turned off
+SERVE_SCRIPTS = {
+    "waitress": """
+import sys
+from hordeling import APP
+from hordeling.limiter import limiter
+from hordeling.consts import WSGI_THREADS
+from waitress import serve
+limiter.enabled = False
+serve(APP, host="127.0.0.1", port=int(sys.argv[1]), threads=WSGI_THREADS, connection_limit=4096, asyncore_use_poll=True)
+""",
+    "asgi": """
+import sys
+import uvicorn
+from hordeling.asgi import app
+from hordeling.limiter import limiter
+limiter.enabled = False
+uvicorn.run(app, host="127.0.0.1", port=int(sys.argv[1]), log_level="error", limit_concurrency=4096)
+""",
+}
+
+bench_parser = argparse.ArgumentParser(description="Compares the slow-upstream capacity of waitress and the async serving mode")
+bench_parser.add_argument('--servers', action="store", default="waitress,asgi", type=str, help="Comma-separated servers to measure")
+bench_parser.add_argument('--concurrency', action="store", default="16,64,256", type=str, help="Comma-separated amounts of concurrent clients")
+bench_parser.add_argument('--rounds', action="store", default=2, type=int, help="How many requests each client sends at every level")
+bench_parser.add_argument('--civitai-latency', action="store", default=2, type=float, help="Seconds of latency added to each CivitAI response")
+bench_parser.add_argument('--s3-latency', action="store", default=0.2, type=float, help="Seconds of latency added to each R2 response")
+bench_parser.add_argument('--port', action="store", default=7601, type=int, help="The port the servers listen on")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def start_server(server, port, env, workdir):
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVE_SCRIPTS[server], str(port)],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    import requests
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The {server} server exited with {process.returncode}")
+        try:
+            if requests.get(f"http://127.0.0.1:{port}/metrics", timeout=1).ok:
+                return process
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"The {server} server did not start in time")
+
+
+async def run_level(base_url, model_ids, concurrency):
+    import httpx
+    latencies = []
+    errors = 0
+    queue = list(model_ids)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+
+        async def client_loop():
+            nonlocal errors
+            while queue:
+                model_id = queue.pop()
+                start = time.perf_counter()
+                try:
+                    response = await client.get(f"{base_url}/api/v1/embedding/{model_id}")
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[client_loop() for _ in range(concurrency)])
+        wall_seconds = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "throughput": len(latencies) / wall_seconds,
+    }
+
+
+def main():
+    args = bench_parser.parse_args()
+    from tests.fakes import FakeCivitAI, FakeS3
+    levels = [int(level) for level in args.concurrency.split(",")]
+    model_count = sum(level * args.rounds for level in levels)
+    civitai = FakeCivitAI(range(1, model_count + 1), vectors=1, latency=args.civitai_latency).start()
+    s3 = FakeS3(latency=args.s3_latency).start()
+    # Every model is already converted, so we only measure how the servers wait on upstream
+    safetensor = b"benchmark"
+    sha256 = hashlib.sha256(safetensor).hexdigest()
+    for model_id in civitai.models:
+        s3.objects[f"benchmark_{model_id}_{model_id * 10}.safetensors"] = (safetensor, {"sha256": sha256})
+    env = {
+        **os.environ,
+        "PYTHONPATH": REPO_ROOT,
+        "CIVITAI_API_URL": civitai.api_url,
+        "R2_SAFETENSORS_ACCOUNT": s3.url,
+        "AWS_ACCESS_KEY_ID": os.getenv("AWS_ACCESS_KEY_ID", "benchmark"),
+        "AWS_SECRET_ACCESS_KEY": os.getenv("AWS_SECRET_ACCESS_KEY", "benchmark"),
+        "AWS_DEFAULT_REGION": os.getenv("AWS_DEFAULT_REGION", "auto"),
+        # Nothing listens on port 6379 of this address, so both servers use their in-memory fallbacks
+        "REDIS_IP": "127.0.0.2",
+        "REDIS_CONNECT_TIMEOUT": "0.1",
+    }
+    print(f"CivitAI latency {args.civitai_latency}s, R2 latency {args.s3_latency}s")
+    print(f"{'server':<10}{'clients':>8}{'requests':>10}{'errors':>8}{'p50':>9}{'p95':>9}{'req/s':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for server in args.servers.split(","):
+            process = start_server(server, args.port, env, workdir)
+            try:
+                first_model_id = 1
+                for level in levels:
+                    model_ids = range(first_model_id, first_model_id + level * args.rounds)
+                    first_model_id += level * args.rounds
+                    result = asyncio.run(run_level(f"http://127.0.0.1:{args.port}", model_ids, level))
+                    print(f"{server:<10}{level:>8}{result['requests']:>10}{result['errors']:>8}"
+                          f"{result['p50']:>9.3f}{result['p95']:>9.3f}{result['throughput']:>9.1f}")
+            finally:
+                process.terminate()
+                process.wait()
+    civitai.stop()
+    s3.stop()
+
+
+if __name__ == "__main__":
+    main()
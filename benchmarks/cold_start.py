@@ -0,0 +1,74 @@
+"""Measures how long a fresh process takes to import the server, and how much memory it uses doing so
+
+Each measurement runs in a new interpreter, so nothing is shared between runs.
+Exits with an error if the median import time or the peak RSS goes over its budget,
+or if any of the modules which should only be loaded on demand were imported.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed for conversions or uploads, so a node serving cache hits should never load them
+LAZY_MODULES = ["torch", "boto3", "numpy", "safetensors"]
+
+MEASURE_SCRIPT = """
+import json
+import resource
+import sys
+import time
+start = time.perf_counter()
+import hordeling
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    "import_seconds": elapsed,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "lazy_modules_loaded": [module for module in %r if module in sys.modules],
+}))
+""" % (LAZY_MODULES,)
+
+arg_parser = argparse.ArgumentParser(description="Measures the cold start of the hordeling server")
+arg_parser.add_argument('--runs', action="store", default=5, type=int, help="How many fresh processes to measure")
+arg_parser.add_argument('--max-import-seconds', action="store", default=float(os.getenv("HORDELING_MAX_IMPORT_SECONDS", 3)), type=float, help="The budget for the median import time")
+arg_parser.add_argument('--max-rss-mb', action="store", default=float(os.getenv("HORDELING_MAX_RSS_MB", 150)), type=float, help="The budget for the peak RSS after importing")
+
+
+def measure_once():
+    result = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+        # Make sure we don't wait on a redis which isn't there
+        env={**os.environ, "REDIS_CONNECT_TIMEOUT": os.getenv("REDIS_CONNECT_TIMEOUT", "0.2")},
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    args = arg_parser.parse_args()
+    runs = [measure_once() for _ in range(args.runs)]
+    import_seconds = statistics.median(run["import_seconds"] for run in runs)
+    max_rss_mb = max(run["max_rss_mb"] for run in runs)
+    lazy_modules_loaded = sorted({module for run in runs for module in run["lazy_modules_loaded"]})
+    print(f"Median import time: {import_seconds:.3f}s (budget {args.max_import_seconds}s)")
+    print(f"Peak RSS: {max_rss_mb:.1f}MB (budget {args.max_rss_mb}MB)")
+    failures = []
+    if import_seconds > args.max_import_seconds:
+        failures.append(f"Import time {import_seconds:.3f}s is over its budget of {args.max_import_seconds}s")
+    if max_rss_mb > args.max_rss_mb:
+        failures.append(f"Peak RSS {max_rss_mb:.1f}MB is over its budget of {args.max_rss_mb}MB")
+    if lazy_modules_loaded:
+        failures.append(f"Modules which should be lazily loaded were imported: {', '.join(lazy_modules_loaded)}")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+"""Drives the embedding API through typical workloads, entirely offline
+
+The Flask APP is served by waitress, like in production, while CivitAI and R2 are replaced
+by the local stand-ins from tests/fakes.py. Redis is used if --redis-ip is given, otherwise the
+hordeling falls back to its in-memory modes.
+
+Workloads:
+    cold:  every request is for a different model which has never been converted
+    warm:  every request is for a model which has already been converted
+    herd:  many clients ask for the same new model at the same moment
+    mixed: requests follow a zipf distribution over models, some hot and some cold
+
+Results can be stored as a baseline with --save-baseline and compared against with --baseline,
+in which case the run fails if the p95 latency or the throughput regressed more than --tolerance.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKLOADS = ["cold", "warm", "herd", "mixed"]
+
+bench_parser = argparse.ArgumentParser(description="Offline load test of the hordeling embedding API")
+bench_parser.add_argument('--workloads', action="store", default=",".join(WORKLOADS), type=str, help="Comma-separated workloads to run")
+bench_parser.add_argument('--requests', action="store", default=500, type=int, help="How many requests the warm and mixed workloads send")
+bench_parser.add_argument('--concurrency', action="store", default=16, type=int, help="How many clients send requests at the same time")
+bench_parser.add_argument('--models', action="store", default=50, type=int, help="How many models each workload uses")
+bench_parser.add_argument('--vectors', action="store", default=8, type=int, help="The amount of 768-wide vectors in each embedding, which sets the file size")
+bench_parser.add_argument('--civitai-latency', action="store", default=0.05, type=float, help="Seconds of latency added to each CivitAI response")
+bench_parser.add_argument('--s3-latency', action="store", default=0.02, type=float, help="Seconds of latency added to each R2 response")
+bench_parser.add_argument('--redis-ip', action="store", default=None, type=str, help="Use the redis on this IP, instead of the in-memory fallbacks")
+bench_parser.add_argument('--baseline', action="store", default=None, type=str, help="Compare the results against this baseline file")
+bench_parser.add_argument('--save-baseline', action="store", default=None, type=str, help="Store the results as a baseline in this file")
+bench_parser.add_argument('--tolerance', action="store", default=0.2, type=float, help="How much worse than the baseline a result may be")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, wall_seconds, errors, extra=None):
+    summary = {
+        "requests": len(latencies),
+        "errors": errors,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "throughput": len(latencies) / wall_seconds if wall_seconds else 0,
+    }
+    summary.update(extra or {})
+    return summary
+
+
+class LoadTest:
+
+    def __init__(self, args, base_url, civitai):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.args = args
+        self.base_url = base_url
+        self.civitai = civitai
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=args.concurrency))
+        self.lock = threading.Lock()
+        self.errors = 0
+        self.next_model_id = 1
+
+    def new_model_ids(self, count):
+        with self.lock:
+            model_ids = list(range(self.next_model_id, self.next_model_id + count))
+            self.next_model_id += count
+        return model_ids
+
+    def request(self, model_id):
+        """Returns the latency of a single request along with its response"""
+        start = time.perf_counter()
+        response = self.session.get(f"{self.base_url}/api/v1/embedding/{model_id}")
+        return time.perf_counter() - start, response
+
+    def resolve(self, model_id, timeout=120):
+        """Requests the model until its download url is ready
+        Returns the latency of the first request, and the time until the url was available
+        """
+        start = time.perf_counter()
+        latency, response = self.request(model_id)
+        if response.status_code == 202:
+            job_id = response.json()["job_id"]
+            while time.perf_counter() - start < timeout:
+                job = self.session.get(f"{self.base_url}/api/v1/jobs/{job_id}").json()
+                if job["status"] in ["done", "failed"]:
+                    if job["status"] == "failed":
+                        self.record_error(f"Job for {model_id} failed: {job.get('message')}")
+                    break
+                time.sleep(0.05)
+        elif response.status_code != 200:
+            self.record_error(f"{model_id} returned {response.status_code}: {response.text}")
+        return latency, time.perf_counter() - start
+
+    def record_error(self, message):
+        with self.lock:
+            self.errors += 1
+        print(f"  error: {message}", file=sys.stderr)
+
+    def run_parallel(self, func, items):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            results = list(executor.map(func, items))
+        return results, time.perf_counter() - start
+
+    def cold(self):
+        results, wall_seconds = self.run_parallel(self.resolve, self.new_model_ids(self.args.models))
+        return summarize(
+            [latency for latency, _ in results], wall_seconds, self.errors,
+            {"ready_p50": percentile([ready for _, ready in results], 0.50),
+             "ready_p95": percentile([ready for _, ready in results], 0.95)},
+        )
+
+    def warm(self):
+        model_ids = self.new_model_ids(self.args.models)
+        self.run_parallel(self.resolve, model_ids)
+        chosen = [random.choice(model_ids) for _ in range(self.args.requests)]
+        results, wall_seconds = self.run_parallel(self.request, chosen)
+        for _, response in results:
+            if response.status_code != 200:
+                self.record_error(f"Warm request returned {response.status_code}")
+        return summarize([latency for latency, _ in results], wall_seconds, self.errors)
+
+    def herd(self):
+        model_id = self.new_model_ids(1)[0]
+        barrier = threading.Barrier(self.args.concurrency)
+
+        def stampede(_):
+            barrier.wait()
+            return self.resolve(model_id)
+
+        results, wall_seconds = self.run_parallel(stampede, range(self.args.concurrency))
+        return summarize(
+            [latency for latency, _ in results], wall_seconds, self.errors,
+            {"ready_p95": percentile([ready for _, ready in results], 0.95),
+             "downloads": self.civitai.downloads.get(model_id, 0)},
+        )
+
+    def mixed(self):
+        model_ids = self.new_model_ids(self.args.models)
+        # A handful of popular models get most of the requests, like in production
+        weights = [1 / rank for rank in range(1, len(model_ids) + 1)]
+        chosen = random.choices(model_ids, weights=weights, k=self.args.requests)
+        results, wall_seconds = self.run_parallel(self.resolve, chosen)
+        return summarize(
+            [latency for latency, _ in results], wall_seconds, self.errors,
+            {"ready_p95": percentile([ready for _, ready in results], 0.95)},
+        )
+
+
+def get_worker_peak_rss_mb(executor):
+    """The peak RSS of the largest conversion worker, while they're still running
+    RUSAGE_CHILDREN can't be used, as it counts the memory the workers shared with us when they were started
+    """
+    peak_kb = 0
+    for pid in list(getattr(executor, "_processes", None) or {}):
+        try:
+            with open(f"/proc/{pid}/status") as status_file:
+                for line in status_file:
+                    if line.startswith("VmHWM:"):
+                        peak_kb = max(peak_kb, int(line.split()[1]))
+        except OSError:
+            continue
+    return peak_kb / 1024
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    for workload, result in results.items():
+        if workload not in baseline:
+            continue
+        expected = baseline[workload]
+        if expected.get("p95") and result["p95"] > expected["p95"] * (1 + tolerance):
+            regressions.append(f"{workload}: p95 {result['p95']:.4f}s is worse than the baseline {expected['p95']:.4f}s")
+        if expected.get("throughput") and result["throughput"] < expected["throughput"] * (1 - tolerance):
+            regressions.append(f"{workload}: throughput {result['throughput']:.1f}/s is worse than the baseline {expected['throughput']:.1f}/s")
+    return regressions
+
+
+def main():
+    args, _ = bench_parser.parse_known_args()
+    from tests.fakes import FakeCivitAI, FakeS3
+    # Plenty of model ids for every workload, as each one uses new models
+    civitai = FakeCivitAI(range(1, args.models * 4 + 2), vectors=args.vectors, latency=args.civitai_latency).start()
+    s3 = FakeS3(latency=args.s3_latency).start()
+    # The hordeling reads its configuration when imported, so it all needs to be set before
+    os.environ["CIVITAI_API_URL"] = civitai.api_url
+    os.environ["R2_SAFETENSORS_ACCOUNT"] = s3.url
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "auto")
+    # Our S3 stand-in doesn't understand streamed checksums
+    os.environ.setdefault("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+    # The cold and herd workloads queue far more conversions than admission control would let a node take
+    os.environ.setdefault("HORDELING_CONVERSION_MAX_JOBS", str(args.models * 4))
+    os.environ["REDIS_IP"] = args.redis_ip or "127.0.0.1"
+    if args.redis_ip is None:
+        # Nothing listens on port 6379 of this address, so every redis check fails fast
+        os.environ["REDIS_IP"] = "127.0.0.2"
+        os.environ["REDIS_CONNECT_TIMEOUT"] = "0.1"
+
+    from waitress import create_server
+    from hordeling import APP
+    from hordeling import jobs
+    from hordeling.limiter import limiter
+    from hordeling.consts import WSGI_THREADS
+    # We're a single client sending far more than any real one would
+    limiter.enabled = False
+    server = create_server(APP, host="127.0.0.1", port=0, threads=WSGI_THREADS)
+    threading.Thread(target=server.run, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.effective_port}"
+
+    load_test = LoadTest(args, base_url, civitai)
+    results = {}
+    for workload in args.workloads.split(","):
+        load_test.errors = 0
+        print(f"Running {workload} workload")
+        results[workload] = getattr(load_test, workload)()
+        print("  " + ", ".join(
+            f"{key}={value:.4f}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in results[workload].items()
+        ))
+    worker_peak_mb = get_worker_peak_rss_mb(jobs.executor)
+    if jobs.executor is not None:
+        jobs.executor.shutdown()
+    print(f"Peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB, "
+          f"largest conversion worker {worker_peak_mb:.1f}MB")
+    print(f"CivitAI metadata requests: {civitai.metadata_requests}, downloads: {sum(civitai.downloads.values())}, R2 requests: {s3.requests}")
+    server.close()
+    civitai.stop()
+    s3.stop()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
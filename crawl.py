@@ -0,0 +1,189 @@
+"""Converts pickletensor embeddings ahead of time, so that no user has to wait for them
+
+Either pages through all the Textual Inversions on CivitAI, or reads model IDs from a file (one per line).
+Progress is stored in a checkpoint file, so an interrupted run continues where it stopped.
+"""
+from dotenv import load_dotenv
+import argparse
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+load_dotenv()
+
+crawl_parser = argparse.ArgumentParser(description="Pre-converts CivitAI pickletensor embeddings to safetensors")
+crawl_parser.add_argument('--ids-file', action="store", default=None, required=False, type=str, help="A file with one CivitAI model ID per line. If not set, all Textual Inversions on CivitAI are crawled")
+crawl_parser.add_argument('--checkpoint', action="store", default="crawl_checkpoint.json", required=False, type=str, help="Where to store the progress of this crawl")
+crawl_parser.add_argument('--concurrency', action="store", default=4, required=False, type=int, help="How many models to convert at the same time")
+crawl_parser.add_argument('--page-size', action="store", default=100, required=False, type=int, help="How many models to request from CivitAI per page")
+crawl_parser.add_argument('--max-pages', action="store", default=None, required=False, type=int, help="Stop after this many CivitAI pages")
+crawl_parser.add_argument('--civitai-url', action="store", default=None, required=False, type=str, help="Use a different CivitAI API, such as a local stand-in")
+crawl_args, _ = crawl_parser.parse_known_args()
+
+# This has to be set before hordeling reads its configuration
+if crawl_args.civitai_url:
+    os.environ["CIVITAI_API_URL"] = crawl_args.civitai_url
+
+from loguru import logger
+from hordeling.civitai import CivitAIModel
+from hordeling import exceptions as e
+from hordeling import civitai_cache
+from hordeling.sessions import civitai_session
+from hordeling.consts import CIVITAI_API_URL, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+
+class Checkpoint:
+    """The progress of a crawl
+    Every change is appended to the file as a line of json, so that saving doesn't get slower as the crawl goes on.
+    When a crawl starts, the file is compacted to a single line with everything done so far
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.cursor = None
+        self.pages = 0
+        self.done = set()
+        self.failed = {}
+        if os.path.exists(filename):
+            self.load()
+            logger.info(f"Resuming crawl from {filename} with {len(self.done)} models done")
+        self.compact()
+        self.checkpoint_file = open(filename, "a")
+
+    def load(self):
+        with open(self.filename) as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # An interruption can leave the last line half written
+                    continue
+                self.apply(entry)
+
+    def apply(self, entry):
+        if "cursor" in entry:
+            self.cursor = entry["cursor"]
+        if "pages" in entry:
+            self.pages = entry["pages"]
+        self.done.update(entry.get("done", []))
+        self.failed.update(entry.get("failed", {}))
+
+    def compact(self):
+        # We write to a temporary file first, so that an interruption never leaves a broken checkpoint
+        tmp_filename = f"{self.filename}.tmp"
+        with open(tmp_filename, "w") as checkpoint_file:
+            json.dump({
+                "cursor": self.cursor,
+                "pages": self.pages,
+                "done": sorted(self.done),
+                "failed": self.failed,
+            }, checkpoint_file)
+            checkpoint_file.write("\n")
+        os.replace(tmp_filename, self.filename)
+
+    def append(self, entry):
+        self.checkpoint_file.write(json.dumps(entry) + "\n")
+        self.checkpoint_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.checkpoint_file.close()
+
+    def is_done(self, model_id):
+        return model_id in self.done or model_id in self.failed
+
+    def mark_done(self, model_id):
+        with self.lock:
+            self.done.add(model_id)
+            self.append({"done": [model_id]})
+
+    def mark_failed(self, model_id, message):
+        with self.lock:
+            self.failed[model_id] = message
+            self.append({"failed": {model_id: message}})
+
+    def next_page(self, cursor):
+        with self.lock:
+            self.cursor = cursor
+            self.pages += 1
+            self.append({"cursor": cursor, "pages": self.pages})
+
+
+def convert_model(model_id, checkpoint):
+    if checkpoint.is_done(model_id):
+        return
+    try:
+        model = CivitAIModel(model_id)
+        if not model.is_valid():
+            # Anything other than a missing model might work on the next run
+            if model.rc == 404 or model.model_metadata is not None:
+                checkpoint.mark_failed(model_id, model.fault_msg)
+            else:
+                logger.warning(f"Could not retrieve {model_id}: {model.fault_msg}")
+            return
+        if model.type != "TextualInversion" or not model.is_safe:
+            checkpoint.mark_failed(model_id, f"{model.name} is not a safe Textual Inversion")
+            return
+        if model.needs_conversion():
+            model.convert_safetensor()
+            model.get_sha256()
+            logger.info(f"Pre-converted {model_id} ({model.name})")
+        elif model.safetensor_url is None:
+            model.index_safetensor(model.get_safetensor_key(), model.get_sha256())
+        checkpoint.mark_done(model_id)
+    except (e.BadRequest, NotImplementedError) as err:
+        message = getattr(err, "specific", None) or str(err)
+        logger.warning(f"Could not pre-convert {model_id}: {message}")
+        checkpoint.mark_failed(model_id, message)
+    except Exception as err:
+        # Temporary failures are not stored, so that the next run retries them
+        message = getattr(err, "specific", None) or str(err)
+        logger.warning(f"Temporary failure when pre-converting {model_id}: {message}")
+
+
+def crawl_ids_file(ids_filename, checkpoint, executor):
+    with open(ids_filename) as ids_file:
+        model_ids = [line.strip() for line in ids_file if line.strip().isdigit()]
+    list(executor.map(lambda model_id: convert_model(model_id, checkpoint), model_ids))
+
+
+def crawl_civitai(checkpoint, executor):
+    params = {"types": "TextualInversion", "limit": crawl_args.page_size, "sort": "Newest"}
+    while crawl_args.max_pages is None or checkpoint.pages < crawl_args.max_pages:
+        page_params = dict(params)
+        if checkpoint.cursor is not None:
+            page_params["cursor"] = checkpoint.cursor
+        civreq = civitai_session.get(
+            f"{CIVITAI_API_URL}/models",
+            params=page_params,
+            timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+        )
+        if not civreq.ok:
+            logger.error(f"Error {civreq.status_code} when listing CivitAI models: {civreq.text}")
+            return
+        page = civreq.json()
+        model_ids = []
+        for item in page.get("items", []):
+            model_id = str(item["id"])
+            # The listing has the same metadata as the model endpoint, so we save ourselves the request
+            civitai_cache.store_metadata(model_id, item)
+            model_ids.append(model_id)
+        list(executor.map(lambda model_id: convert_model(model_id, checkpoint), model_ids))
+        next_cursor = page.get("metadata", {}).get("nextCursor")
+        if next_cursor is None:
+            logger.info("Reached the end of the CivitAI listings")
+            return
+        checkpoint.next_page(next_cursor)
+
+
+if __name__ == "__main__":
+    checkpoint = Checkpoint(crawl_args.checkpoint)
+    with ThreadPoolExecutor(max_workers=crawl_args.concurrency) as executor:
+        if crawl_args.ids_file:
+            crawl_ids_file(crawl_args.ids_file, checkpoint, executor)
+        else:
+            crawl_civitai(checkpoint, executor)
+    checkpoint.close()
+    logger.info(f"Crawl finished with {len(checkpoint.done)} models done and {len(checkpoint.failed)} failed")
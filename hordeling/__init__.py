@@ -6,21 +6,32 @@ from hordeling.flask import APP
 from hordeling.routes import *
 from hordeling.apis import apiv1
 from hordeling.argparser import args
-from hordeling.consts import HORDELING_VERSION
-import hashlib
+from hordeling.consts import HORDELING_VERSION, ETAG_MAX_HASH_BYTES
+from flask import request
 
 APP.register_blueprint(apiv1)
 
 
+def get_common_headers():
+    """The headers we add to every response, whichever way it was served"""
+    return {
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Methods": "POST, GET, OPTIONS, PUT, DELETE, PATCH",
+        "Access-Control-Allow-Headers": "Accept, Content-Type, Content-Length, Accept-Encoding, X-CSRF-Token, apikey, Client-Agent, X-Fields, If-None-Match",
+        "Hordeling-Node": f"{socket.gethostname()}:{args.port}:{HORDELING_VERSION}",
+    }
+
+
 @APP.after_request
 def after_request(response):
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "POST, GET, OPTIONS, PUT, DELETE, PATCH"
-    response.headers["Access-Control-Allow-Headers"] = "Accept, Content-Type, Content-Length, Accept-Encoding, X-CSRF-Token, apikey, Client-Agent, X-Fields"
-    response.headers["Hordeling-Node"] = f"{socket.gethostname()}:{args.port}:{HORDELING_VERSION}"
-    try:
-        etag = hashlib.sha1(response.get_data()).hexdigest()
-    except RuntimeError:
-        etag = "Runtime Error"
-    response.headers["ETag"] = etag
+    response.headers.update(get_common_headers())
+    if request.method in ["GET", "HEAD"] and response.status_code == 200:
+        # Endpoints which know what their response is made of set their own ETag.
+        # For the rest we only hash small bodies which are already in memory
+        if "ETag" not in response.headers and not response.is_streamed and not response.direct_passthrough:
+            content_length = response.calculate_content_length()
+            if content_length is not None and content_length <= ETAG_MAX_HASH_BYTES:
+                response.add_etag()
+        if "ETag" in response.headers:
+            response.make_conditional(request)
     return response
@@ -11,4 +11,23 @@ class Models:
         self.response_model_download_url = api.model('DownloadURL', {
             'url': fields.String(description="The download url for the provided model"),
             'sha256': fields.String(description="The hash of the safetensor file. If empty, the one from CivitAI should be used"),
+            'job_id': fields.String(description="When the model is still being converted, the ID of the conversion job to poll"),
+        })
+        self.response_model_download_url_result = api.inherit('DownloadURLResult', self.response_model_download_url, {
+            'model_id': fields.String(description="The CivitAI model ID this result is for"),
+            'code': fields.Integer(description="The status code this model would have received as a single request"),
+            'message': fields.String(description="The error message, if this model could not be resolved"),
+        })
+        self.response_model_batch_download_urls = api.model('BatchDownloadURLs', {
+            'results': fields.List(fields.Nested(self.response_model_download_url_result, skip_none=True)),
+        })
+        self.response_model_job = api.model('ConversionJob', {
+            'id': fields.String(description="The ID of this conversion job"),
+            'model_id': fields.String(description="The CivitAI model ID being converted"),
+            'status': fields.String(description="The current stage of the conversion", enum=["queued", "waiting", "converting", "uploading", "done", "failed"]),
+            'message': fields.String(description="Details about why the conversion failed"),
+            'url': fields.String(description="The download url of the converted safetensor, once the job is done"),
+            'sha256': fields.String(description="The hash of the converted safetensor, once the job is done"),
+            'created': fields.Float(description="When this job was queued, as a unix timestamp"),
+            'updated': fields.Float(description="When this job last changed stage, as a unix timestamp"),
         })
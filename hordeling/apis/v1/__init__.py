@@ -2,3 +2,5 @@ import hordeling.apis.v1.base as base
 from hordeling.apis.v1.base import api
 
 api.add_resource(base.Embedding, "/embedding/<string:model_id>")
+api.add_resource(base.Embeddings, "/embeddings")
+api.add_resource(base.Job, "/jobs/<string:job_id>")
@@ -1,10 +1,17 @@
 import os
-from flask import request
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from flask import request, Response
 from flask_restx import Namespace, Resource, reqparse
-from hordeling.flask import cache
 from loguru import logger
 from hordeling import exceptions as e
-from hordeling.civitai import CivitAIModel
+from hordeling import jobs
+from hordeling import r2
+from hordeling import etags
+from hordeling import metrics
+from hordeling.limiter import limiter, get_client_identity
+from hordeling.resolve import serve_embedding
+from hordeling.consts import BATCH_MAX_MODELS, BATCH_CONCURRENCY, REQUEST_LIMIT
 
 api = Namespace('v1', 'API Version 1' )
 
@@ -18,37 +25,108 @@ handle_unauthorized = api.errorhandler(e.Unauthorized)(e.handle_bad_requests)
 handle_not_found = api.errorhandler(e.NotFound)(e.handle_bad_requests)
 handle_internal_server_error = api.errorhandler(e.InternalServerError)(e.handle_bad_requests)
 handle_service_unavailable = api.errorhandler(e.ServiceUnavailable)(e.handle_bad_requests)
+handle_too_many_requests = api.errorhandler(e.TooManyRequests)(e.handle_bad_requests)
 
 # Used to for the flask limiter, to limit requests per url paths
 def get_request_path():
     # logger.info(dir(request))
     return f"{request.remote_addr}@{request.method}@{request.path}"
 
+# Clients which already have the current download details get a 304 without us resolving the model
+def conditional_on_embedding_etag(func):
+    @wraps(func)
+    def wrapper(self, model_id):
+        if request.if_none_match:
+            etag = etags.get_embedding_etag(model_id)
+            metrics.record_cache("conditional_get", etag is not None and request.if_none_match.contains(etag))
+            if etag is not None and request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+        return func(self, model_id)
+    return wrapper
+
 
 class Embedding(Resource):
     get_parser = reqparse.RequestParser()
     get_parser.add_argument("Client-Agent", default="unknown:0:unknown", type=str, required=False, help="The client name and version.", location="headers")
+    get_parser.add_argument("If-None-Match", type=str, required=False, help="The ETag of the download details the client already has.", location="headers")
 
     @api.expect(get_parser)
-    @cache.cached(timeout=10, query_string=True)
+    @conditional_on_embedding_etag
     @api.marshal_with(models.response_model_download_url, code=200, description='Download URL', skip_none=True)
+    @api.response(202, 'Conversion Queued')
+    @api.response(304, 'Not Modified')
+    @api.response(429, 'Conversion Budget Spent', models.response_model_error)
+    @api.response(503, 'Too Busy To Convert', models.response_model_error)
     def get(self, model_id: str):
         '''Ensure the download URL for an embedding is a safetensor
         '''
         self.args = self.get_parser.parse_args()
-        if not model_id.isdigit():
-            raise e.BadRequest("You can only pass CivitAI mdoel IDs")
-        model: CivitAIModel = CivitAIModel(model_id)
-        if not model.is_valid():
-            if model.rc == 404:
-                raise e.NotFound(model.fault_msg)
-            else:
-                raise e.ServiceUnavailable(model.fault_msg)
-        if not model:
-            raise e.BadRequest(f"{model.name} has not passed the CivitAI pickle scanner succesfully")
-        if model.type != "TextualInversion":
-            raise e.BadRequest(f"{model.name} is not an Embedding / Textual Inversion")
-        return {
-            "url": model.get_safetensors_download(),
-            "sha256": model.get_sha256(),
-            },200
+        return serve_embedding(model_id, get_client_identity())
+
+
+def serve_embedding_result(model_id: str, client_identity):
+    """Same as serve_embedding() but returns errors as part of the result instead of raising them"""
+    try:
+        result, code, _ = serve_embedding(model_id, client_identity)
+    except (e.BadRequest, e.NotFound, e.ServiceUnavailable, e.TooManyRequests) as err:
+        result, code = {"message": err.specific}, err.code
+    except Exception as err:
+        logger.exception(f"Unexpected error when resolving embedding {model_id}: {err}")
+        result, code = {"message": "Internal error when resolving this embedding"}, 500
+    result["model_id"] = model_id
+    result["code"] = code
+    return result
+
+
+# Each model in a batch request counts as one request against the request limit
+def get_batch_weight():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get("model_ids"), list):
+        return 1
+    return max(1, min(len(payload["model_ids"]), BATCH_MAX_MODELS))
+
+
+# reqparse would turn a whole json list into a single string when it's given type=str
+def model_id_list(value):
+    if not isinstance(value, list):
+        raise ValueError("model_ids has to be a list")
+    return [str(model_id) for model_id in value]
+
+
+class Embeddings(Resource):
+    decorators = [limiter.limit(REQUEST_LIMIT, cost=get_batch_weight)]
+    post_parser = reqparse.RequestParser()
+    post_parser.add_argument("Client-Agent", default="unknown:0:unknown", type=str, required=False, help="The client name and version.", location="headers")
+    post_parser.add_argument("model_ids", type=model_id_list, required=True, help="The CivitAI model IDs to resolve.", location="json")
+
+    @api.expect(post_parser)
+    @api.marshal_with(models.response_model_batch_download_urls, code=200, description='Download URLs', skip_none=True)
+    @api.response(400, 'Validation Error', models.response_model_error)
+    def post(self):
+        '''Ensure the download URLs for many embeddings are safetensors
+        Each embedding gets its own result, with either its download details or an error
+        '''
+        self.args = self.post_parser.parse_args()
+        model_ids = list(dict.fromkeys(self.args.model_ids))
+        if len(model_ids) > BATCH_MAX_MODELS:
+            raise e.BadRequest(f"You can only request up to {BATCH_MAX_MODELS} embeddings at once")
+        client_identity = get_client_identity()
+        with ThreadPoolExecutor(max_workers=max(1, min(BATCH_CONCURRENCY, len(model_ids)))) as executor:
+            results = list(executor.map(lambda model_id: serve_embedding_result(model_id, client_identity), model_ids))
+        return {"results": results}, 200
+
+class Job(Resource):
+
+    @api.marshal_with(models.response_model_job, code=200, description='Conversion Job', skip_none=True)
+    @api.response(404, 'Job not found', models.response_model_error)
+    def get(self, job_id: str):
+        '''Check the progress of a conversion job
+        '''
+        job = jobs.get_job(job_id)
+        if job is None:
+            raise e.NotFound(f"Conversion job {job_id} does not exist or has expired")
+        if job["status"] == "done":
+            job["url"] = r2.generate_safetensor_download_url(job["safetensor_filename"])
+        return job, 200
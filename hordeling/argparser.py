@@ -7,4 +7,5 @@ arg_parser.add_argument('-q', '--quiet', action='count', default=0, help="The de
 arg_parser.add_argument('-p', '--port', action='store', default=12001, required=False, type=int, help="Provide a different port to start with")
 arg_parser.add_argument('--test', action="store_true", help="Test")
 arg_parser.add_argument('--color', default=False, action="store_true", help="Enabled colorized logs")
-args = arg_parser.parse_args()
+# We ignore unknown arguments so that other entry points, like the crawler, can bring their own
+args, _ = arg_parser.parse_known_args()
@@ -0,0 +1,90 @@
+"""The async serving mode, started by server_async.py
+
+The embedding endpoint is served on the event loop with non-blocking clients, so slow upstream
+requests don't each tie up a thread. Everything else is passed through to the flask APP.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from limits import parse
+from loguru import logger
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Mount, Route
+from uvicorn.middleware.wsgi import WSGIMiddleware
+from werkzeug.http import parse_etags, quote_etag
+
+from hordeling import APP, get_common_headers
+from hordeling import async_clients
+from hordeling import exceptions as e
+from hordeling import etags
+from hordeling import hordeling_redis
+from hordeling import r2
+from hordeling.limiter import limiter, call_limiter, DEFAULT_CLIENT_AGENT
+from hordeling.resolve import serve_embedding_steps
+from hordeling.consts import WSGI_THREADS, REQUEST_LIMIT
+
+EMBEDDING_LIMIT = parse(REQUEST_LIMIT)
+
+
+def get_client_ip(request: Request):
+    """Same as the ProxyFix in front of the flask APP, which trusts the one proxy in front of us
+    so that the client is the last hop that proxy added to X-Forwarded-For
+    """
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for:
+        return forwarded_for.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+
+async def embedding(request: Request):
+    model_id = request.path_params["model_id"]
+    headers = get_common_headers()
+    client_ip = get_client_ip(request)
+    client_identity = (client_ip, request.headers.get("Client-Agent", DEFAULT_CLIENT_AGENT))
+    if limiter.enabled:
+        allowed = await asyncio.to_thread(call_limiter, "hit", EMBEDDING_LIMIT, "asgi_embedding", client_ip)
+        if not allowed:
+            return JSONResponse({"message": f"Rate limit exceeded: {EMBEDDING_LIMIT}"}, status_code=429, headers=headers)
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        etag = await async_clients.run_async(etags.get_embedding_etag_steps(model_id))
+        if etag is not None and parse_etags(if_none_match).contains(etag):
+            headers["ETag"] = quote_etag(etag)
+            return Response(status_code=304, headers=headers)
+    try:
+        result, code, extra_headers = await async_clients.run_async(serve_embedding_steps(model_id, client_identity))
+    except (e.BadRequest, e.NotFound, e.ServiceUnavailable, e.TooManyRequests) as err:
+        if err.log:
+            logger.warning(err.log)
+        if getattr(err, "retry_after", None) is not None:
+            headers["Retry-After"] = str(err.retry_after)
+        return JSONResponse({"message": err.specific}, status_code=err.code, headers=headers)
+    except Exception as err:
+        logger.exception(f"Unexpected error when resolving embedding {model_id}: {err}")
+        return JSONResponse({"message": "Internal Server Error"}, status_code=500, headers=headers)
+    headers.update(extra_headers)
+    return JSONResponse(result, status_code=code, headers=headers)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # The blocking code we hand over to threads gets as many of them as waitress would
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=WSGI_THREADS))
+    await asyncio.to_thread(hordeling_redis.init_hordeling_redis)
+    await async_clients.init_async_clients()
+    # Creating the R2 client imports boto3, which we'd rather not do on the event loop later
+    await asyncio.to_thread(r2.get_s3_client)
+    yield
+    await async_clients.close_async_clients()
+
+
+app = Starlette(
+    routes=[
+        Route("/api/v1/embedding/{model_id}", embedding, methods=["GET"]),
+        Mount("/", app=WSGIMiddleware(APP, workers=WSGI_THREADS)),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,218 @@
+"""Non-blocking CivitAI, R2 and redis clients for the async serving mode in asgi.py
+
+They are the non-blocking twins of the blocking I/O in the lookups of steps.py, which run_async() swaps in.
+The rare writes which follow a miss are handed to the blocking code in a thread.
+"""
+import asyncio
+import json
+
+import httpx
+import redis.asyncio as aioredis
+from loguru import logger
+
+from hordeling import hordeling_redis
+from hordeling import civitai
+from hordeling import metrics
+from hordeling import r2
+from hordeling.redis_ctrl import get_all_async_redis_db_servers
+from hordeling.consts import CIVITAI_API_URL, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES, ASYNC_HTTP_MAX_CONNECTIONS, REDIS_L1_TTL_SECONDS
+
+# One client per redis server, in the same order as hordeling_redis.all_hordeling_redis,
+# so that both serving modes share which servers failed and the write quorum
+all_aredis = []
+http_client = None
+# Writes which already reached their quorum keep going to the slower servers in the background
+background_writes = set()
+
+
+async def init_async_clients():
+    global all_aredis, http_client
+    http_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        limits=httpx.Limits(max_connections=ASYNC_HTTP_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_HTTP_MAX_CONNECTIONS),
+        transport=httpx.AsyncHTTPTransport(retries=HTTP_RETRIES),
+    )
+    await asyncio.to_thread(hordeling_redis.init_hordeling_redis)
+    if hordeling_redis.hordeling_r is not None:
+        all_aredis = get_all_async_redis_db_servers()
+        logger.init_ok("Async Redis", status=f"Connected to {len(all_aredis)} servers")
+    else:
+        logger.init_err("Async Redis", status="Failed")
+
+
+async def close_async_clients():
+    if http_client is not None:
+        await http_client.aclose()
+    for aredis in all_aredis:
+        await aredis.close()
+
+
+async def run_on_server(index, commands):
+    """Same as hordeling_redis.run_on_server()"""
+    try:
+        pipeline = all_aredis[index].pipeline(transaction=False)
+        commands(pipeline)
+        results = await pipeline.execute()
+    except (aioredis.ConnectionError, aioredis.TimeoutError) as err:
+        hordeling_redis.mark_server_failed(index, err)
+        return None
+    hordeling_redis.server_retry_at.pop(index, None)
+    return results
+
+
+async def write_to_all(commands):
+    """Same as hordeling_redis.write_to_all()"""
+    if not all_aredis:
+        return False
+    if len(all_aredis) == 1:
+        return await run_on_server(0, commands) is not None
+    indexes, quorum = hordeling_redis.get_write_servers()
+    tasks = [asyncio.create_task(run_on_server(index, commands)) for index in indexes]
+    background_writes.update(tasks)
+    for task in tasks:
+        task.add_done_callback(background_writes.discard)
+    successes = 0
+    failures = 0
+    for finished in asyncio.as_completed(tasks):
+        if await finished is not None:
+            successes += 1
+        else:
+            failures += 1
+        if successes >= quorum:
+            return True
+        if failures > len(indexes) - quorum:
+            break
+    logger.error(f"Redis write only reached {successes} of the {quorum} servers it needed")
+    return False
+
+
+async def read_with_failover(commands):
+    """Same as hordeling_redis.read_with_failover()"""
+    for index in hordeling_redis.get_servers_by_health():
+        results = await run_on_server(index, commands)
+        if results is not None:
+            return results
+    return None
+
+
+async def r_get(key):
+    """Same as hordeling_redis.hordeling_r_get(), sharing its in-process tier"""
+    value = hordeling_redis.local_values.get(key)
+    metrics.record_cache("redis_l1", value is not None)
+    if value is not None:
+        return value
+    if not all_aredis:
+        return None
+    results = await read_with_failover(lambda pipeline: pipeline.get(key).ttl(key))
+    if results is None:
+        return None
+    value, remote_ttl = results
+    if value is not None and remote_ttl != 0:
+        hordeling_redis.remember_locally(key, value, remote_ttl if remote_ttl > 0 else REDIS_L1_TTL_SECONDS)
+    return value
+
+
+async def r_get_json(key):
+    value = await r_get(key)
+    if value is None:
+        return None
+    return json.loads(value)
+
+
+async def r_setex(key, expiry, value):
+    """Same as hordeling_redis.hordeling_r_setex()"""
+    await write_to_all(lambda pipeline: pipeline.setex(key, expiry, value))
+    hordeling_redis.remember_locally(key, value, expiry.total_seconds())
+
+
+async def r_setex_json(key, expiry, value):
+    await r_setex(key, expiry, json.dumps(value))
+
+
+async def r_set(key, value):
+    """Same as hordeling_redis.hordeling_r_set()"""
+    await write_to_all(lambda pipeline: pipeline.set(key, value))
+    hordeling_redis.remember_locally(key, value)
+
+
+async def request_model_metadata(model_id, headers):
+    with metrics.time_stage("civitai_metadata"):
+        return await http_client.get(f"{CIVITAI_API_URL}/models/{model_id}", headers=headers)
+
+
+async def head_safetensor(filename):
+    """Same as r2.head_safetensor()
+    The HEAD request goes through a presigned url, which we can sign without any I/O
+    """
+    url = r2.generate_presigned_url(r2.get_s3_client(), "head_object", {'Bucket': r2.r2_bucket, 'Key': filename})
+    try:
+        with metrics.time_stage("r2_head"):
+            response = await http_client.head(url)
+    except httpx.HTTPError as err:
+        logger.error(f"Error when checking {filename} in R2: {err}")
+        return False
+    if response.is_success:
+        return {
+            header[len("x-amz-meta-"):]: value
+            for header, value in response.headers.items()
+            if header.startswith("x-amz-meta-")
+        }
+    if response.status_code == 404:
+        return None
+    return False
+
+
+async def get_content_index_object(pickletensor_hash):
+    """Same as r2.get_content_index_object()"""
+    url = r2.generate_presigned_url(r2.get_s3_client(), "get_object", {'Bucket': r2.r2_bucket, 'Key': r2.get_content_index_key(pickletensor_hash)})
+    try:
+        with metrics.time_stage("r2_index_get"):
+            response = await http_client.get(url)
+    except httpx.HTTPError as err:
+        logger.error(f"Error encountered while reading the content index of {pickletensor_hash}: {err}")
+        return False
+    if response.status_code == 404:
+        return None
+    if not response.is_success:
+        logger.error(f"Error {response.status_code} while reading the content index of {pickletensor_hash}")
+        return False
+    return response.json()
+
+
+# The blocking I/O of the shared lookups in steps.py, which we have non-blocking clients for
+ASYNC_CALLS = {
+    hordeling_redis.hordeling_r_get: r_get,
+    hordeling_redis.hordeling_r_get_json: r_get_json,
+    hordeling_redis.hordeling_r_setex: r_setex,
+    hordeling_redis.hordeling_r_setex_json: r_setex_json,
+    hordeling_redis.hordeling_r_set: r_set,
+    civitai.request_model_metadata: request_model_metadata,
+    r2.head_safetensor: head_safetensor,
+    r2.get_content_index_object: get_content_index_object,
+}
+
+
+async def run_async(steps):
+    """Same as steps.run(), but with our non-blocking clients
+    Any other blocking call runs in a thread, as it's either a rare write or needs the CPU
+    """
+    result = None
+    error = None
+    while True:
+        try:
+            if error is not None:
+                next_call = steps.throw(error)
+            else:
+                next_call = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            async_function = ASYNC_CALLS.get(next_call.function)
+            if async_function is not None:
+                result = await async_function(*next_call.args)
+            else:
+                result = await asyncio.to_thread(next_call.function, *next_call.args)
+            error = None
+        except Exception as err:
+            result = None
+            error = err
@@ -1,11 +1,20 @@
 import os
-import requests
+import time
 from loguru import logger
 from pathlib import Path
 import hashlib
-from hordeling.convert_to_safetensors import download_and_convert_pickletensor, download_created_safetensor
+from hordeling.convert_to_safetensors import download_and_convert_pickletensor, download_and_convert_pickletensor_in_memory, download_created_safetensor, fits_in_memory
 from hordeling import r2
 from hordeling import hordeling_redis
+from hordeling import civitai_cache
+from hordeling import negative_cache
+from hordeling import content_index
+from hordeling import metrics
+from hordeling.local_cache import models_cache
+from hordeling.sessions import civitai_session
+from hordeling import exceptions as e
+from hordeling.steps import call, run
+from hordeling.consts import CONVERSION_LEASE_SECONDS, CONVERSION_WAIT_SECONDS, CONVERSION_POLL_SECONDS, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, CIVITAI_API_URL
 
 class CivitAIModel:
 
@@ -14,18 +23,25 @@ class CivitAIModel:
     type: str = None
     name: str = None
     is_safe: bool = True
+    unsafe_file_id: str = None
     safetensor_url: str = None
     pickletensor_url: str = None
     pickletensor_hash: str = None
     pickletensor_id: str = None
+    pickletensor_size_kb: float = None
     filename: Path = None
     filepath: Path = None
     _fault_msg:  str = None
     rc: int = 200
 
-    def __init__(self, model_id):
+    def __init__(self, model_id, model_metadata=None):
+        """
+        :param model_metadata: The CivitAI metadata of the model, if it's already been retrieved
+        """
         self.model_id = model_id
-        self.model_metadata = self.retrieve_model_metadata(model_id)
+        if model_metadata is None:
+            model_metadata = self.retrieve_model_metadata(model_id)
+        self.model_metadata = model_metadata
         if self.model_metadata is None:
             return
         self.type = self.model_metadata['type']
@@ -50,26 +66,22 @@ class CivitAIModel:
             return f"The model '{self.name}' is of an unexpected type"
 
     def retrieve_model_metadata(self, model_id):
-        try:
-            civreq = requests.get(f"https://civitai.com/api/v1/models/{model_id}", timeout=5)
-            if not civreq.ok:
-                self.rc = civreq.status_code
-                if civreq.status_code == 404:
-                    self._fault_msg = f"Model {model_id} does not exist"
-                else:
-                    self._fault_msg = f"Error {civreq.status_code} when retrieving CivitAI metadata for {model_id}: {civreq.text}"
-                logger.error(self._fault_msg)
-                return
-            return civreq.json()
-        except Exception as err:
-            self._fault_msg = f"Exception when retrieving CivitAI metadata for {model_id} with error: {err}"
-            logger.error(self._fault_msg)
+        metadata, self.rc, fault_msg = run(retrieve_model_metadata_steps(model_id))
+        if fault_msg is not None:
+            self._fault_msg = fault_msg
+        return metadata
 
     def set_safe(self):
         files = self.model_metadata["modelVersions"][0]["files"]
         for f in files:
             if f["pickleScanResult"] != "Success":
                 self.is_safe = False
+                self.unsafe_file_id = f["id"]
+
+    @property
+    def file_ids(self):
+        """The ids of all the files of the model, which change whenever it's re-uploaded"""
+        return [f["id"] for f in self.model_metadata["modelVersions"][0]["files"]]
 
     def set_safetensor(self):
         files = self.model_metadata["modelVersions"][0]["files"]
@@ -90,6 +102,7 @@ class CivitAIModel:
                 self.filename = Path(f["name"])
                 self.filepath = Path("models/" + f["name"])
                 self.pickletensor_id = f["id"]
+                self.pickletensor_size_kb = f.get("sizeKB")
 
     def get_safetensor_filepath(self):
         # We attach the model filepath id in the filepath to know if it's receiverd a new version
@@ -99,35 +112,219 @@ class CivitAIModel:
         # We attach the model filepath id in the filepath to know if it's receiverd a new version
         return f"{self.filepath.stem}_{self.pickletensor_id}.safetensors"
 
+    def get_conversion_id(self):
+        """Identifies the conversion of this model, which is the same for every upload of the same pickletensor"""
+        if self.pickletensor_hash is not None:
+            return content_index.normalize_hash(self.pickletensor_hash)
+        return self.get_safetensor_filename()
+
+    def get_safetensor_key(self, use_cache=True):
+        """Returns the key of our safetensor object in R2
+        A pickletensor which was already converted for another model maps to that object.
+        Otherwise it's our own safetensor filename
+        """
+        return run(self.get_safetensor_key_steps(use_cache))
+
+    def get_safetensor_key_steps(self, use_cache=True):
+        entry = yield from content_index.get_content_entry_steps(self.pickletensor_hash, use_cache=use_cache)
+        if entry is None or entry["key"] == self.get_safetensor_filename():
+            return self.get_safetensor_filename()
+        # We only map to the object of another model once we know it's there
+        if (yield from r2.check_safetensor_steps(entry["key"], use_cache)):
+            return entry["key"]
+        logger.warning(f"The content index of {self.name} points to the missing {entry['key']}")
+        return self.get_safetensor_filename()
+
+    def index_safetensor(self, safetensor_key, sha256):
+        return run(self.index_safetensor_steps(safetensor_key, sha256))
+
+    def index_safetensor_steps(self, safetensor_key, sha256):
+        """Adds our own safetensor object to the content index, when it was converted before the index existed
+        or its entry was lost, so that identical pickletensors of other models map to it
+        """
+        if self.pickletensor_hash is None or safetensor_key != self.get_safetensor_filename():
+            return
+        entry = yield from content_index.get_content_entry_steps(self.pickletensor_hash)
+        # An entry with another key points to an object which is missing, or we wouldn't be using our own
+        if entry is None or entry["key"] != safetensor_key:
+            yield call(content_index.store_content_entry, self.pickletensor_hash, safetensor_key, sha256)
+
+    def is_converted(self):
+        """Same as needs_conversion() but asks R2 itself instead of our caches"""
+        return r2.check_safetensor(self.get_safetensor_key(use_cache=False), use_cache=False)
+
     def ensure_dir_exists(self):
         os.makedirs(self.filepath.parents[0], exist_ok=True)
 
     def get_safetensors_download(self):
+        entry = self.get_safetensors_download_entry()
+        if entry is not None:
+            return entry["url"]
+
+    def get_safetensors_download_entry(self):
+        """Returns a dict with the download url and the timestamp it expires on
+        CivitAI's own safetensor urls do not expire, so theirs is None
+        """
         if self.safetensor_url is not None:
-            return self.safetensor_url
+            return {"url": self.safetensor_url, "expires": None}
         if self.pickletensor_url:
-            if not r2.check_safetensor(self.get_safetensor_filename()):
-                download_and_convert_pickletensor(self)
-                r2.upload_safetensor(self)
-                logger.info(f"Converted and uploaded {self.name}")
-            return r2.generate_safetensor_download_url(self.get_safetensor_filename())
+            if not r2.check_safetensor(self.get_safetensor_key()):
+                self.convert_safetensor()
+            return r2.get_safetensor_download_url_entry(self.get_safetensor_key())
+
+    def needs_conversion(self):
+        if self.safetensor_url is not None or self.pickletensor_url is None:
+            return False
+        return not r2.check_safetensor(self.get_safetensor_key())
+
+    def convert_safetensor(self, progress=None):
+        """Converts the pickletensor and uploads the result to R2
+        Only the holder of the conversion lease does the work.
+        Everyone else in the cluster waits for its result instead.
+        The lease is per pickletensor hash, so that identical files under other models wait for it as well
+
+        :param progress: Optional callable which receives the name of each conversion stage as it starts
+        """
+        if progress is None:
+            progress = lambda status: None
+        lease_key = f"conversion_lease:{self.get_conversion_id()}"
+        deadline = time.monotonic() + CONVERSION_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            token = hordeling_redis.hordeling_r_acquire_lease(lease_key, CONVERSION_LEASE_SECONDS)
+            if token is not None:
+                metrics.conversions_in_flight.inc()
+                try:
+                    # The previous lease holder might have finished between our check and now
+                    if not self.is_converted():
+                        progress("converting")
+                        if fits_in_memory(self):
+                            safetensor_bytes, sha256 = download_and_convert_pickletensor_in_memory(self)
+                        else:
+                            safetensor_bytes = None
+                            sha256 = download_and_convert_pickletensor(self)
+                        self.store_sha256(sha256)
+                        progress("uploading")
+                        if safetensor_bytes is not None:
+                            uploaded = r2.upload_safetensor_bytes(self.get_safetensor_filename(), safetensor_bytes, sha256)
+                        else:
+                            uploaded = r2.upload_safetensor(self, sha256)
+                        if not uploaded:
+                            raise e.ServiceUnavailable(f"Could not upload the safetensor of {self.name}. Please try again later.")
+                        content_index.store_content_entry(self.pickletensor_hash, self.get_safetensor_filename(), sha256)
+                        logger.info(f"Converted and uploaded {self.name}")
+                finally:
+                    metrics.conversions_in_flight.dec()
+                    hordeling_redis.hordeling_r_release_lease(lease_key, token)
+                return
+            logger.debug(f"Waiting for another conversion of {self.name} to finish")
+            progress("waiting")
+            while hordeling_redis.hordeling_r_lease_exists(lease_key):
+                if time.monotonic() > deadline:
+                    break
+                time.sleep(CONVERSION_POLL_SECONDS)
+            if self.is_converted():
+                return
+            # If the lease is gone and there's still no safetensor, the lease holder failed
+            # so we try to take over the conversion ourselves
+        raise e.ServiceUnavailable(f"Timed out while waiting for {self.name} to be converted. Please try again later.")
 
     def get_sha256(self):
+        return run(self.get_sha256_steps())
+
+    def get_sha256_steps(self):
         if self.safetensor_url is not None:
             return None
-        hash = hordeling_redis.hordeling_r_get(self.model_id)
+        hash = yield call(hordeling_redis.hordeling_r_get, self.model_id)
+        if hash is not None:
+            return hash
+        # Identical pickletensors converted for other models already know their hash
+        entry = yield from content_index.get_content_entry_steps(self.pickletensor_hash)
+        if entry is not None and entry.get("sha256") is not None:
+            hash = entry["sha256"]
+        else:
+            # Hot models are usually still in our local cache
+            hash = yield call(self.hash_cached_safetensor)
         if hash is None:
-            stpath = Path(self.get_safetensor_filepath())
-            if not stpath.exists():
-                download_created_safetensor(self)
-            return self.store_sha256()
+            safetensor_key = yield from self.get_safetensor_key_steps()
+            hash = yield from r2.get_safetensor_sha256_steps(safetensor_key)
+        if hash is None:
+            # Safetensors uploaded before we stored their hash in R2 need to be hashed one last time
+            hash = yield call(self.hash_created_safetensor)
+        yield call(self.store_sha256, hash)
+        return hash
+
+    def hash_cached_safetensor(self):
+        """Returns the hash of our local copy of the safetensor, or None if we don't have one"""
+        if not models_cache.touch(self.get_safetensor_filepath()):
+            return None
+        return self.hash_safetensor_file()
+
+    def hash_created_safetensor(self):
+        download_created_safetensor(self)
+        hash = self.hash_safetensor_file()
+        r2.set_safetensor_sha256(self.get_safetensor_key(), hash)
         return hash
 
-    def store_sha256(self):
+    def hash_safetensor_file(self):
         hash_object = hashlib.sha256()
-        with open(self.get_safetensor_filepath(), "rb") as file:
+        with metrics.time_stage("hash"), open(self.get_safetensor_filepath(), "rb") as file:
             while chunk := file.read(8192):  # Read the file in chunks of 8KB
                 hash_object.update(chunk)
-        sha256 = hash_object.hexdigest()
-        hordeling_redis.hordeling_r_set(self.model_id,sha256)
-        return sha256
+        return hash_object.hexdigest()
+
+    def store_sha256(self, sha256):
+        hordeling_redis.hordeling_r_set(self.model_id, sha256)
+
+
+def request_model_metadata(model_id, headers):
+    with metrics.time_stage("civitai_metadata"):
+        return civitai_session.get(
+            f"{CIVITAI_API_URL}/models/{model_id}",
+            headers=headers,
+            timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+        )
+
+
+def retrieve_model_metadata_steps(model_id):
+    """Returns the CivitAI metadata of the model or None, the status code and the fault message if it failed
+    Fresh metadata comes from our cache, and stale metadata is revalidated with CivitAI
+    """
+    cached_entry = yield from civitai_cache.get_metadata_entry_steps(model_id)
+    if cached_entry is not None and civitai_cache.is_fresh(cached_entry):
+        return cached_entry["metadata"], 200, None
+    headers = {}
+    if cached_entry is not None:
+        headers = civitai_cache.get_revalidation_headers(cached_entry)
+    try:
+        civreq = yield call(request_model_metadata, model_id, headers)
+        if cached_entry is not None:
+            metrics.record_cache("metadata_revalidation", civreq.status_code == 304)
+        if civreq.status_code == 304 and cached_entry is not None:
+            yield call(civitai_cache.mark_revalidated, model_id, cached_entry)
+            return cached_entry["metadata"], 200, None
+        if not 200 <= civreq.status_code < 300:
+            if civreq.status_code == 404:
+                fault_msg = f"Model {model_id} does not exist"
+                yield call(negative_cache.record_failure, model_id, "not_found", 404, fault_msg)
+            else:
+                fault_msg = f"Error {civreq.status_code} when retrieving CivitAI metadata for {model_id}: {civreq.text}"
+                yield call(negative_cache.record_failure, model_id, "upstream_error", 503, fault_msg)
+            logger.error(fault_msg)
+            return None, civreq.status_code, fault_msg
+        metadata = civreq.json()
+        yield call(
+            civitai_cache.store_metadata,
+            model_id,
+            metadata,
+            civreq.headers.get("ETag"),
+            civreq.headers.get("Last-Modified"),
+        )
+        return metadata, 200, None
+    except Exception as err:
+        # When CivitAI is having trouble, stale metadata is better than nothing
+        if cached_entry is not None:
+            logger.warning(f"Using stale CivitAI metadata for {model_id} due to error: {err}")
+            return cached_entry["metadata"], 200, None
+        fault_msg = f"Exception when retrieving CivitAI metadata for {model_id} with error: {err}"
+        logger.error(fault_msg)
+        return None, 200, fault_msg
@@ -0,0 +1,64 @@
+import time
+from datetime import timedelta
+
+from hordeling import hordeling_redis
+from hordeling import metrics
+from hordeling.steps import call, run
+from hordeling.ttl_cache import TTLCache
+from hordeling.consts import METADATA_FRESH_SECONDS, METADATA_RETENTION_SECONDS, METADATA_LRU_SIZE
+
+# The process-local tier in front of redis
+local_metadata = TTLCache(METADATA_LRU_SIZE, METADATA_RETENTION_SECONDS)
+
+
+def get_metadata_entry(model_id):
+    """Returns the cached CivitAI metadata entry for this model from the fastest tier that has it
+    The entry is a dict with the metadata, its validators (etag, last_modified) and when it was fetched
+    """
+    return run(get_metadata_entry_steps(model_id))
+
+
+def get_metadata_entry_steps(model_id):
+    entry = local_metadata.get(model_id)
+    metrics.record_cache("metadata_local", entry is not None)
+    if entry is not None:
+        return entry
+    entry = yield call(hordeling_redis.hordeling_r_get_json, f"civitai_metadata:{model_id}")
+    metrics.record_cache("metadata_redis", entry is not None)
+    if entry is not None:
+        local_metadata.set(model_id, entry)
+    return entry
+
+
+def is_fresh(entry):
+    return time.time() - entry["fetched"] < METADATA_FRESH_SECONDS
+
+
+def get_revalidation_headers(entry):
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def store_metadata(model_id, metadata, etag=None, last_modified=None):
+    entry = {
+        "metadata": metadata,
+        "etag": etag,
+        "last_modified": last_modified,
+        "fetched": time.time(),
+    }
+    local_metadata.set(model_id, entry)
+    hordeling_redis.hordeling_r_setex_json(
+        f"civitai_metadata:{model_id}",
+        timedelta(seconds=METADATA_RETENTION_SECONDS),
+        entry,
+    )
+    return entry
+
+
+def mark_revalidated(model_id, entry):
+    """CivitAI told us our stale copy is still current, so we just make it fresh again"""
+    return store_metadata(model_id, entry["metadata"], entry.get("etag"), entry.get("last_modified"))
@@ -1 +1,112 @@
+import os
+
 HORDELING_VERSION = "0.1.0"
+
+# How long a node may hold the conversion lease for a single safetensor before it's considered dead
+CONVERSION_LEASE_SECONDS = int(os.getenv("HORDELING_CONVERSION_LEASE_SECONDS", 600))
+# How long a request will wait for another node to finish converting the same safetensor
+CONVERSION_WAIT_SECONDS = int(os.getenv("HORDELING_CONVERSION_WAIT_SECONDS", 120))
+CONVERSION_POLL_SECONDS = float(os.getenv("HORDELING_CONVERSION_POLL_SECONDS", 0.5))
+
+# The amount of worker processes converting pickletensors in the background
+CONVERSION_WORKERS = int(os.getenv("HORDELING_CONVERSION_WORKERS", os.cpu_count() or 1))
+# How many conversion jobs this node accepts at once, counting those still queued for a worker
+CONVERSION_MAX_JOBS = int(os.getenv("HORDELING_CONVERSION_MAX_JOBS", CONVERSION_WORKERS * 4))
+# How much memory the accepted conversion jobs may need together. A single job is always accepted when nothing else is running
+CONVERSION_MEMORY_BUDGET_BYTES = int(os.getenv("HORDELING_CONVERSION_MEMORY_BUDGET_BYTES", 2 * 1024 * 1024 * 1024))
+# Loading a pickletensor and serializing it again takes a few times its own size
+CONVERSION_MEMORY_FACTOR = float(os.getenv("HORDELING_CONVERSION_MEMORY_FACTOR", 4))
+# When the size is missing from the metadata, we expect the pickletensor to be this large
+CONVERSION_DEFAULT_SIZE_BYTES = int(os.getenv("HORDELING_CONVERSION_DEFAULT_SIZE_BYTES", 1024 * 1024))
+# What we tell clients we turned away, about how long a conversion takes
+CONVERSION_RETRY_AFTER_SECONDS = int(os.getenv("HORDELING_CONVERSION_RETRY_AFTER_SECONDS", 30))
+# How long the status of a conversion job is kept around after its last update
+JOB_EXPIRY_SECONDS = int(os.getenv("HORDELING_JOB_EXPIRY_SECONDS", 3600))
+
+# Pickletensors bigger than this are refused, as embeddings should never be this large
+PICKLETENSOR_MAX_BYTES = int(os.getenv("HORDELING_PICKLETENSOR_MAX_BYTES", 200 * 1024 * 1024))
+# Pickletensors up to this size are downloaded, converted and uploaded without touching the disk
+IN_MEMORY_MAX_BYTES = int(os.getenv("HORDELING_IN_MEMORY_MAX_BYTES", 16 * 1024 * 1024))
+DOWNLOAD_CHUNK_BYTES = int(os.getenv("HORDELING_DOWNLOAD_CHUNK_BYTES", 1024 * 1024))
+DOWNLOAD_CONNECT_TIMEOUT = float(os.getenv("HORDELING_DOWNLOAD_CONNECT_TIMEOUT", 5))
+# This is the maximum time between two chunks, not the time for the whole download
+DOWNLOAD_READ_TIMEOUT = float(os.getenv("HORDELING_DOWNLOAD_READ_TIMEOUT", 30))
+
+# CivitAI metadata younger than this is used without asking CivitAI again
+METADATA_FRESH_SECONDS = int(os.getenv("HORDELING_METADATA_FRESH_SECONDS", 300))
+# Stale metadata is kept this long so that we can revalidate it with a conditional request
+METADATA_RETENTION_SECONDS = int(os.getenv("HORDELING_METADATA_RETENTION_SECONDS", 7 * 24 * 3600))
+METADATA_LRU_SIZE = int(os.getenv("HORDELING_METADATA_LRU_SIZE", 2048))
+
+# The amount of waitress threads. Connection pools are sized to match, so that no thread waits for a connection
+WSGI_THREADS = int(os.getenv("HORDELING_WSGI_THREADS", 45))
+HTTP_RETRIES = int(os.getenv("HORDELING_HTTP_RETRIES", 3))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HORDELING_HTTP_CONNECT_TIMEOUT", 3.05))
+HTTP_READ_TIMEOUT = float(os.getenv("HORDELING_HTTP_READ_TIMEOUT", 10))
+# The async serving mode isn't limited by threads, so it can keep many more upstream requests open at once
+ASYNC_HTTP_MAX_CONNECTIONS = int(os.getenv("HORDELING_ASYNC_HTTP_MAX_CONNECTIONS", 512))
+
+# The in-process cache in front of redis reads. Values are kept very briefly, as other nodes may change them
+REDIS_L1_SIZE = int(os.getenv("HORDELING_REDIS_L1_SIZE", 8192))
+REDIS_L1_MAX_BYTES = int(os.getenv("HORDELING_REDIS_L1_MAX_BYTES", 32 * 1024 * 1024))
+REDIS_L1_TTL_SECONDS = float(os.getenv("HORDELING_REDIS_L1_TTL_SECONDS", 5))
+REDIS_LOCK_STRIPES = int(os.getenv("HORDELING_REDIS_LOCK_STRIPES", 64))
+# With multiple REDIS_SERVERS, how many need to have a write before it's done. 0 means the majority
+REDIS_WRITE_QUORUM = int(os.getenv("HORDELING_REDIS_WRITE_QUORUM", 0))
+# How long we skip a redis server after it failed us
+REDIS_RETRY_SECONDS = float(os.getenv("HORDELING_REDIS_RETRY_SECONDS", 10))
+
+# Safetensors never disappear from R2 on their own, so we can remember that they exist for a long time
+R2_EXISTS_TTL_SECONDS = int(os.getenv("HORDELING_R2_EXISTS_TTL_SECONDS", 24 * 3600))
+# But missing ones might be uploaded by another node at any moment
+R2_MISSING_TTL_SECONDS = int(os.getenv("HORDELING_R2_MISSING_TTL_SECONDS", 10))
+R2_URL_EXPIRY_SECONDS = int(os.getenv("HORDELING_R2_URL_EXPIRY_SECONDS", 1800))
+# Presigned URLs are reused until they have less than this many seconds left
+R2_URL_MIN_REMAINING_SECONDS = int(os.getenv("HORDELING_R2_URL_MIN_REMAINING_SECONDS", 300))
+R2_CACHE_SIZE = int(os.getenv("HORDELING_R2_CACHE_SIZE", 4096))
+# Conversions overwrite the content index entry of their pickletensor in redis, so we can remember that one is missing for a while
+CONTENT_INDEX_MISSING_TTL_SECONDS = int(os.getenv("HORDELING_CONTENT_INDEX_MISSING_TTL_SECONDS", 3600))
+
+# Responses without an ETag of their own only get one by hashing their body if they are at most this large
+ETAG_MAX_HASH_BYTES = int(os.getenv("HORDELING_ETAG_MAX_HASH_BYTES", 64 * 1024))
+
+# Resolved download details are served for this long before they are refreshed in the background
+RESPONSE_CACHE_FRESH_SECONDS = int(os.getenv("HORDELING_RESPONSE_CACHE_FRESH_SECONDS", 60))
+# Stale download details are still served while they are refreshed, for up to this long
+RESPONSE_CACHE_RETENTION_SECONDS = int(os.getenv("HORDELING_RESPONSE_CACHE_RETENTION_SECONDS", 24 * 3600))
+RESPONSE_CACHE_SIZE = int(os.getenv("HORDELING_RESPONSE_CACHE_SIZE", 4096))
+RESPONSE_REFRESH_WORKERS = int(os.getenv("HORDELING_RESPONSE_REFRESH_WORKERS", 4))
+RESPONSE_REFRESH_LEASE_SECONDS = int(os.getenv("HORDELING_RESPONSE_REFRESH_LEASE_SECONDS", 30))
+
+# The most embeddings which can be resolved in a single batch request
+BATCH_MAX_MODELS = int(os.getenv("HORDELING_BATCH_MAX_MODELS", 100))
+# How many embeddings of a single batch request are resolved at the same time
+BATCH_CONCURRENCY = int(os.getenv("HORDELING_BATCH_CONCURRENCY", 8))
+
+# Requests which only look up what we already have are cheap, so this limit is only there against floods
+REQUEST_LIMIT = os.getenv("HORDELING_REQUEST_LIMIT", "1200 per minute")
+# Every conversion we start for a client is charged against both of these, separated by semicolons
+CONVERSION_LIMITS_PER_IP = os.getenv("HORDELING_CONVERSION_LIMITS_PER_IP", "10 per minute;60 per hour")
+CONVERSION_LIMITS_PER_CLIENT_AGENT = os.getenv("HORDELING_CONVERSION_LIMITS_PER_CLIENT_AGENT", "60 per minute;600 per hour")
+
+# Can be pointed to a local stand-in of the CivitAI API for testing
+CIVITAI_API_URL = os.getenv("CIVITAI_API_URL", "https://civitai.com/api/v1").rstrip("/")
+
+# How many bytes the downloaded and converted files may take in the models directory before the oldest are deleted
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("HORDELING_LOCAL_CACHE_MAX_BYTES", 5 * 1024 * 1024 * 1024))
+
+# How long we remember each kind of failure, so that we don't repeat the work which led to it
+NEGATIVE_CACHE_DEFAULT_TTLS = {
+    "not_found": 3600,
+    "upstream_error": 15,
+    "unsafe": 7 * 24 * 3600,
+    "wrong_type": 24 * 3600,
+    "too_large": 30 * 24 * 3600,
+    "hash_mismatch": 600,
+    "unsupported": 30 * 24 * 3600,
+}
+NEGATIVE_CACHE_TTLS = {
+    failure: int(os.getenv(f"HORDELING_NEGATIVE_TTL_{failure.upper()}", ttl))
+    for failure, ttl in NEGATIVE_CACHE_DEFAULT_TTLS.items()
+}
+NEGATIVE_CACHE_LRU_SIZE = int(os.getenv("HORDELING_NEGATIVE_CACHE_LRU_SIZE", 4096))
@@ -0,0 +1,86 @@
+"""Maps the SHA256 of a pickletensor to the safetensor it was converted to
+
+The same embedding file is often uploaded under several models or versions.
+Since the conversion only depends on the file, it's converted once and every later upload maps to that object.
+The index is kept in redis and, as redis may lose it, in one small R2 object per pickletensor.
+"""
+from datetime import timedelta
+
+from loguru import logger
+
+from hordeling import hordeling_redis
+from hordeling import metrics
+from hordeling import r2
+from hordeling.steps import call, run
+from hordeling.ttl_cache import TTLCache
+from hordeling.consts import R2_CACHE_SIZE, R2_EXISTS_TTL_SECONDS, R2_MISSING_TTL_SECONDS, CONTENT_INDEX_MISSING_TTL_SECONDS
+
+# The process-local tier in front of redis. Pickletensors we have no entry for are stored as False, in both
+local_entries = TTLCache(R2_CACHE_SIZE, R2_EXISTS_TTL_SECONDS)
+
+
+def normalize_hash(pickletensor_hash):
+    if pickletensor_hash is None:
+        return None
+    return pickletensor_hash.lower()
+
+
+def get_content_entry(pickletensor_hash, use_cache=True):
+    """Returns a dict with the key of the safetensor object and its sha256, or None if this pickletensor was never converted
+    Set use_cache to False when we need to be sure, such as before starting a conversion
+    """
+    return run(get_content_entry_steps(pickletensor_hash, use_cache))
+
+
+def get_content_entry_steps(pickletensor_hash, use_cache=True):
+    pickletensor_hash = normalize_hash(pickletensor_hash)
+    if pickletensor_hash is None:
+        return None
+    if use_cache:
+        entry = local_entries.get(pickletensor_hash)
+        metrics.record_cache("content_local", entry is not None)
+        if entry is not None:
+            return entry or None
+        entry = yield call(hordeling_redis.hordeling_r_get_json, f"content:{pickletensor_hash}")
+        metrics.record_cache("content_redis", entry is not None)
+        if entry is not None:
+            local_entries.set(pickletensor_hash, entry, ttl=None if entry else R2_MISSING_TTL_SECONDS)
+            return entry or None
+    entry = yield call(r2.get_content_index_object, pickletensor_hash)
+    if entry is False:
+        return None
+    if entry is None:
+        # Another node might convert it at any moment, but then it overwrites our entry in redis
+        local_entries.set(pickletensor_hash, False, ttl=R2_MISSING_TTL_SECONDS)
+        yield call(
+            hordeling_redis.hordeling_r_setex_json,
+            f"content:{pickletensor_hash}",
+            timedelta(seconds=CONTENT_INDEX_MISSING_TTL_SECONDS),
+            False,
+        )
+        return None
+    yield call(remember_content_entry, pickletensor_hash, entry)
+    return entry
+
+
+def remember_content_entry(pickletensor_hash, entry):
+    local_entries.set(pickletensor_hash, entry)
+    hordeling_redis.hordeling_r_set_json(f"content:{pickletensor_hash}", entry)
+
+
+def forget_local_entry(pickletensor_hash):
+    pickletensor_hash = normalize_hash(pickletensor_hash)
+    if pickletensor_hash is not None:
+        local_entries.delete(pickletensor_hash)
+
+
+def store_content_entry(pickletensor_hash, key, sha256):
+    """Records that the pickletensor with this hash was converted to the safetensor object under key"""
+    pickletensor_hash = normalize_hash(pickletensor_hash)
+    if pickletensor_hash is None:
+        return None
+    entry = {"key": key, "sha256": sha256}
+    if not r2.put_content_index_object(pickletensor_hash, entry):
+        logger.warning(f"The content index of {key} is only stored in redis")
+    remember_content_entry(pickletensor_hash, entry)
+    return entry
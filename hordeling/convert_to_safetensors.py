@@ -1,14 +1,21 @@
-from safetensors.torch import load_file, save_file
-
 import os
-import requests
+import io
 import hashlib
+import json
+import mmap
+import pickle
+import struct
 from collections import defaultdict
 from pathlib import Path
 from loguru import logger
-import torch
 from hordeling import r2
+from hordeling import negative_cache
+from hordeling import metrics
+from hordeling.local_cache import models_cache
+from hordeling.sessions import civitai_session, r2_session
 from hordeling import exceptions as e
+from hordeling.consts import PICKLETENSOR_MAX_BYTES, DOWNLOAD_CHUNK_BYTES, DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT, IN_MEMORY_MAX_BYTES
+from hordeling.consts import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
 
 def shared_pointers(tensors):
     ptrs = defaultdict(list)
@@ -22,9 +29,10 @@ def shared_pointers(tensors):
 
 
 def check_file_size(sf_filename: str, pt_filename: str):
-    sf_size = os.stat(sf_filename).st_size
-    pt_size = os.stat(pt_filename).st_size
+    check_size(sf_filename, os.stat(sf_filename).st_size, pt_filename, os.stat(pt_filename).st_size)
+
 
+def check_size(sf_filename: str, sf_size: int, pt_filename: str, pt_size: int):
     if (sf_size - pt_size) / pt_size > 0.01:
         raise RuntimeError(
             f"""The file size different is more than 1%:
@@ -34,6 +42,77 @@ def check_file_size(sf_filename: str, pt_filename: str):
         )
 
 
+def get_tensor_bytes(tensor, is_torch: bool):
+    """Returns a flat uint8 view of the tensor's data, without copying it"""
+    if is_torch:
+        import torch
+        return tensor.detach().contiguous().reshape(-1).view(torch.uint8).numpy()
+    import numpy as np
+    return np.ascontiguousarray(tensor).reshape(-1).view(np.uint8)
+
+
+def verify_safetensors_file(safetensors_filename: str, tensor_bytes: dict):
+    """Compares the source tensor bytes against the data section of the written safetensors file
+    The file is memory-mapped, so the comparison doesn't allocate a second copy of the tensors
+
+    Args:
+        safetensors_filename (str): The safetensors file to verify
+        tensor_bytes (dict): The name of each tensor, along with a flat uint8 view of its data
+    """
+    with open(safetensors_filename, "rb") as safetensors_file:
+        with mmap.mmap(safetensors_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            verify_safetensors_bytes(mapped, tensor_bytes)
+
+
+def verify_safetensors_bytes(safetensor_bytes, tensor_bytes: dict):
+    """Same as verify_safetensors_file() for a safetensor which is in memory, or any other buffer"""
+    try:
+        header_size = struct.unpack_from("<Q", safetensor_bytes, 0)[0]
+        header = json.loads(safetensor_bytes[8:8 + header_size])
+    except (struct.error, ValueError) as err:
+        raise RuntimeError(f"The output header is unreadable: {err}")
+    data_start = 8 + header_size
+    with memoryview(safetensor_bytes) as safetensor_view:
+        for name, source_bytes in tensor_bytes.items():
+            if name not in header:
+                raise RuntimeError(f"The output is missing tensor {name}")
+            start, end = header[name]["data_offsets"]
+            if data_start + end > len(safetensor_bytes):
+                raise RuntimeError(f"The output is truncated in tensor {name}")
+            with safetensor_view[data_start + start:data_start + end] as written, memoryview(source_bytes) as source:
+                if written != source:
+                    raise RuntimeError("The output tensors do not match")
+
+
+def load_pickletensor(input_filename: str, data=None):
+    """Loads the pickletensor with our restricted unpickler
+    Torch is only imported for the rare checkpoints our unpickler cannot read
+
+    Args:
+        input_filename (str): The file to load, or just its name if the data is given
+        data (bytes-like): The contents of the file, if it's already in memory
+
+    Returns:
+        tuple: The loaded model and whether its tensors are torch tensors instead of numpy arrays
+    """
+    # Only conversions need numpy, so we don't import it until then
+    from hordeling import safe_unpickler
+    try:
+        if data is not None:
+            return safe_unpickler.loads(data), False
+        return safe_unpickler.load(input_filename), False
+    except safe_unpickler.UnsupportedCheckpoint as err:
+        logger.warning(f"Falling back to torch to load {input_filename}: {err}")
+    import torch
+    # Torch only loads tensors and plain containers as well, so the fallback can't run arbitrary code either
+    try:
+        if data is not None:
+            return torch.load(io.BytesIO(data), map_location="cpu", weights_only=True), True
+        return torch.load(input_filename, map_location="cpu", weights_only=True), True
+    except pickle.UnpicklingError as err:
+        raise NotImplementedError(f"This model's data is unsupported: {input_filename}") from err
+
+
 def convert_file(
     input_filename: str,
     safetensors_filename: str,
@@ -44,10 +123,60 @@ def convert_file(
         input_filename (str): The input file name
         safetensors_filename (str): The file name to save the converted model to
 
+    Returns:
+        str: The SHA256 of the written safetensors file
     """
     # Load the model from the input file
-    loaded_model = torch.load(input_filename, map_location="cpu")
+    with metrics.time_stage("load"):
+        loaded_model, is_torch = load_pickletensor(input_filename)
+    model_to_save, model_tensors, save = prepare_model_to_save(loaded_model, is_torch, input_filename)
+
+    # Create the output directory if it doesn't exist
+    dirname = os.path.dirname(safetensors_filename)
+    os.makedirs(dirname, exist_ok=True)
+    # Serialize the model parameters and hash them as we write them to the output file
+    with metrics.time_stage("save"):
+        safetensor_bytes = save(model_to_save, metadata={"format": "pt"})
+        sha256 = hashlib.sha256(safetensor_bytes).hexdigest()
+        with open(safetensors_filename, "wb") as outfile:
+            outfile.write(safetensor_bytes)
+        del safetensor_bytes
+    # Check that the output file size is not too large
+    check_file_size(safetensors_filename, input_filename)
+    # Verify that the tensors were saved correctly
+    with metrics.time_stage("verify"):
+        verify_safetensors_file(safetensors_filename, {'emb_params': get_tensor_bytes(model_tensors, is_torch)})
+    return sha256
+
+
+def convert_bytes(input_filename: str, pickletensor_bytes):
+    """Same as convert_file(), but entirely in memory
+
+    Args:
+        input_filename (str): The name of the pickletensor, which decides how it's converted
+        pickletensor_bytes (bytes-like): The contents of the pickletensor
+
+    Returns:
+        tuple: The safetensor bytes and their SHA256
+    """
+    with metrics.time_stage("load"):
+        loaded_model, is_torch = load_pickletensor(input_filename, pickletensor_bytes)
+    model_to_save, model_tensors, save = prepare_model_to_save(loaded_model, is_torch, input_filename)
+    with metrics.time_stage("save"):
+        safetensor_bytes = save(model_to_save, metadata={"format": "pt"})
+        sha256 = hashlib.sha256(safetensor_bytes).hexdigest()
+    check_size("safetensor", len(safetensor_bytes), input_filename, len(pickletensor_bytes))
+    with metrics.time_stage("verify"):
+        verify_safetensors_bytes(safetensor_bytes, {'emb_params': get_tensor_bytes(model_tensors, is_torch)})
+    return safetensor_bytes, sha256
+
+
+def prepare_model_to_save(loaded_model, is_torch: bool, input_filename: str):
+    """Picks the embedding tensors out of the loaded pickletensor
 
+    Returns:
+        tuple: The dict of tensors to save, the embedding tensor, and the safetensors save function to use
+    """
     # Get the file extension
     extension = Path(input_filename).suffix
 
@@ -73,44 +202,135 @@ def convert_file(
         else:
             raise NotImplementedError(f"This model's data is unsupported: {input_filename}")
 
+    if is_torch:
+        from safetensors.torch import save
+    else:
+        from safetensors.numpy import save
+        import numpy as np
+        # safetensors needs contiguous arrays. This only copies if the tensor was a strided view
+        model_tensors = np.ascontiguousarray(model_tensors)
+        model_to_save = {
+            'emb_params': model_tensors
+        }
+    return model_to_save, model_tensors, save
 
-    # Create the output directory if it doesn't exist
-    dirname = os.path.dirname(safetensors_filename)
-    os.makedirs(dirname, exist_ok=True)
-    # Save the model parameters to the output file
-    save_file(model_to_save, safetensors_filename, metadata={"format": "pt"})
-    # Check that the output file size is not too large
-    check_file_size(safetensors_filename, input_filename)
-    # Load the saved model parameters to verify that they were saved correctly
-    reloaded = load_file(safetensors_filename)
 
-    if "reloaded" in reloaded and not torch.equal(model_tensors, reloaded["emb_params"]):
-        raise RuntimeError("The output tensors do not match")
-    elif not torch.equal(model_tensors, reloaded.popitem()[1]):
-        raise RuntimeError("The output tensors do not match")
+def raise_too_large(civitai_model, size):
+    message = f"{civitai_model.name} is too large to convert ({size})"
+    negative_cache.record_failure(civitai_model.model_id, "too_large", 400, message, civitai_model.pickletensor_id)
+    raise e.BadRequest(message)
 
 
-def download_and_convert_pickletensor(civitai_model):
-    response = requests.get(civitai_model.pickletensor_url, timeout=5)
+def fits_in_memory(civitai_model):
+    """Small pickletensors are converted without ever touching the disk"""
+    return civitai_model.pickletensor_size_kb is not None and civitai_model.pickletensor_size_kb * 1024 <= IN_MEMORY_MAX_BYTES
+
+
+def stream_pickletensor(civitai_model, write):
+    """Streams the pickletensor to the write callable while hashing it
+    Raises if the file is too large, or doesn't match its hash once it's complete
+    """
+    if civitai_model.pickletensor_size_kb is not None and civitai_model.pickletensor_size_kb * 1024 > PICKLETENSOR_MAX_BYTES:
+        raise_too_large(civitai_model, f"{civitai_model.pickletensor_size_kb} KB")
     hash_object = hashlib.sha256()
-    hash_object.update(response.content)
+    downloaded_bytes = 0
+    with metrics.time_stage("download"), civitai_session.get(
+        civitai_model.pickletensor_url,
+        stream=True,
+        timeout=(DOWNLOAD_CONNECT_TIMEOUT, DOWNLOAD_READ_TIMEOUT),
+    ) as response:
+        if not response.ok:
+            raise e.ServiceUnavailable(f"Error {response.status_code} when downloading {civitai_model.name} from CivitAI")
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > PICKLETENSOR_MAX_BYTES:
+            raise_too_large(civitai_model, f"{content_length} bytes")
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_BYTES):
+            downloaded_bytes += len(chunk)
+            if downloaded_bytes > PICKLETENSOR_MAX_BYTES:
+                raise_too_large(civitai_model, f"over {PICKLETENSOR_MAX_BYTES} bytes")
+            hash_object.update(chunk)
+            write(chunk)
+    metrics.bytes_transferred.inc("download", "civitai", amount=downloaded_bytes)
     sha256 = hash_object.hexdigest()
     if civitai_model.pickletensor_hash.lower() != sha256.lower():
-        raise e.BadRequest("Downloaded file does not match hash")
+        message = "Downloaded file does not match hash"
+        negative_cache.record_failure(civitai_model.model_id, "hash_mismatch", 400, message, civitai_model.pickletensor_id)
+        raise e.BadRequest(message)
+
+
+def download_pickletensor(civitai_model):
+    """Streams the pickletensor to disk while hashing it
+    so that memory use stays the same no matter the size of the file
+    """
     civitai_model.ensure_dir_exists()
-    with open(civitai_model.filepath, "wb") as outfile:
-    # with open("negative_hand-neg.pt", "wb") as outfile:
-        w = outfile.write(response.content)
+    # We download to a temporary file, so that a partial download is never mistaken for the real file
+    part_filepath = Path(f"{civitai_model.filepath}.part")
+    try:
+        with open(part_filepath, "wb") as outfile:
+            stream_pickletensor(civitai_model, outfile.write)
+        os.replace(part_filepath, civitai_model.filepath)
+        models_cache.add(civitai_model.filepath)
+    finally:
+        part_filepath.unlink(missing_ok=True)
+
+
+def download_pickletensor_bytes(civitai_model):
+    """Downloads the pickletensor into memory"""
+    buffer = bytearray()
+    stream_pickletensor(civitai_model, buffer.extend)
+    return buffer
+
+
+def record_unsupported(civitai_model, err):
+    logger.warning(f"Could not convert {civitai_model.model_id} ({civitai_model.name}) to safetensors: {err}")
+    negative_cache.record_failure(
+        civitai_model.model_id,
+        "unsupported",
+        400,
+        f"{civitai_model.name} cannot be converted to safetensors: {err}",
+        civitai_model.pickletensor_id,
+    )
+
+
+def download_and_convert_pickletensor(civitai_model):
+    download_pickletensor(civitai_model)
     try:
-        convert_file(civitai_model.filepath, civitai_model.get_safetensor_filepath())
+        sha256 = convert_file(civitai_model.filepath, civitai_model.get_safetensor_filepath())
     except NotImplementedError as err:
-        logger.warning(f"Could not convert {civitai_model.model_id} ({civitai_model.name}) to safetensors: {err}")
+        record_unsupported(civitai_model, err)
+        raise err
+    # We never need the pickletensor again once we have the safetensor
+    models_cache.remove(civitai_model.filepath)
+    models_cache.add(civitai_model.get_safetensor_filepath())
+    return sha256
+
+
+def download_and_convert_pickletensor_in_memory(civitai_model):
+    """Same as download_and_convert_pickletensor(), but nothing is written to disk
+
+    Returns:
+        tuple: The safetensor bytes and their SHA256
+    """
+    pickletensor_bytes = download_pickletensor_bytes(civitai_model)
+    try:
+        return convert_bytes(str(civitai_model.filename), pickletensor_bytes)
+    except NotImplementedError as err:
+        record_unsupported(civitai_model, err)
         raise err
 
 def download_created_safetensor(civitai_model):
-    response = requests.get(r2.generate_safetensor_download_url(civitai_model.get_safetensor_filename()), timeout=5)
+    with metrics.time_stage("r2_download"):
+        response = r2_session.get(
+            r2.generate_safetensor_download_url(civitai_model.get_safetensor_key()),
+            timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+        )
+    # An error body would otherwise be hashed and stored as the hash of the safetensor
+    if not response.ok:
+        raise e.ServiceUnavailable(f"Error {response.status_code} when downloading the safetensor of {civitai_model.name} from R2")
+    metrics.bytes_transferred.inc("download", "r2", amount=len(response.content))
     civitai_model.ensure_dir_exists()
     with open(civitai_model.get_safetensor_filepath(), "wb") as outfile:
     # with open("negative_hand-neg.pt", "wb") as outfile:
         w = outfile.write(response.content)
+    models_cache.add(civitai_model.get_safetensor_filepath())
     
\ No newline at end of file
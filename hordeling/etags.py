@@ -0,0 +1,63 @@
+import hashlib
+import time
+from datetime import timedelta
+
+from hordeling import hordeling_redis
+from hordeling import metrics
+from hordeling.steps import call, run
+from hordeling.ttl_cache import TTLCache
+from hordeling.consts import METADATA_FRESH_SECONDS, METADATA_LRU_SIZE, R2_URL_MIN_REMAINING_SECONDS
+
+# The process-local tier in front of redis
+local_etags = TTLCache(METADATA_LRU_SIZE, METADATA_FRESH_SECONDS)
+
+
+def build_embedding_etag(model_id, file_id, sha256, url_expires=None):
+    """The ETag only depends on what the response is made of, so we never need to hash the body itself
+    The expiry of the download url is part of it, so that a newly signed url is a new ETag
+    """
+    return hashlib.sha1(f"{model_id}:{file_id}:{sha256}:{url_expires}".encode()).hexdigest()
+
+
+def store_embedding_etag(model_id, file_id, sha256, url_expires=None):
+    """Remembers the ETag of the current download details of this model, so that conditional requests
+    can be answered without resolving the model again
+
+    We only remember it while the metadata is fresh and the download url is still handed out,
+    as after that the same request could get a different answer
+    """
+    return run(store_embedding_etag_steps(model_id, file_id, sha256, url_expires))
+
+
+def store_embedding_etag_steps(model_id, file_id, sha256, url_expires=None):
+    etag = build_embedding_etag(model_id, file_id, sha256, url_expires)
+    ttl = get_etag_ttl(url_expires)
+    if ttl > 0:
+        local_etags.set(str(model_id), etag, ttl=ttl)
+        yield call(hordeling_redis.hordeling_r_setex, f"embedding_etag:{model_id}", timedelta(seconds=ttl), etag)
+    return etag
+
+
+def get_etag_ttl(url_expires=None):
+    """Returns how many whole seconds the ETag can be kept, as redis rejects an expiry under one second"""
+    ttl = METADATA_FRESH_SECONDS
+    if url_expires is not None:
+        ttl = min(ttl, url_expires - R2_URL_MIN_REMAINING_SECONDS - time.time())
+    return max(0, int(ttl))
+
+
+def get_embedding_etag(model_id):
+    return run(get_embedding_etag_steps(model_id))
+
+
+def get_embedding_etag_steps(model_id):
+    etag = local_etags.get(str(model_id))
+    metrics.record_cache("etag_local", etag is not None)
+    if etag is not None:
+        return etag
+    etag = yield call(hordeling_redis.hordeling_r_get, f"embedding_etag:{model_id}")
+    metrics.record_cache("etag_redis", etag is not None)
+    if etag is not None:
+        # We don't know how long redis would keep it, so we only hold on to it briefly
+        local_etags.set(str(model_id), etag, ttl=min(METADATA_FRESH_SECONDS, 10))
+    return etag
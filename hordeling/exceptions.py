@@ -1,3 +1,4 @@
+from flask import g
 from werkzeug import exceptions as wze
 from loguru import logger
 
@@ -32,12 +33,23 @@ class InternalServerError(wze.InternalServerError):
         self.log = log
         
 class ServiceUnavailable(wze.ServiceUnavailable):
-    def __init__(self, message, log=None):
+    def __init__(self, message, log=None, retry_after=None):
         self.specific = message
         self.log = log
+        self.retry_after = retry_after
         
+class TooManyRequests(wze.TooManyRequests):
+    def __init__(self, message, log=None, retry_after=None):
+        self.specific = message
+        self.log = log
+        self.retry_after = retry_after
+
 def handle_bad_requests(error):
     '''Namespace error handler'''
     if error.log:
         logger.warning(error.log)
+    if getattr(error, "retry_after", None) is not None:
+        # flask-limiter would replace our Retry-After with when the request limit resets
+        g.retry_after = error.retry_after
+        return({'message': error.specific}, error.code, {'Retry-After': str(error.retry_after)})
     return({'message': error.specific}, error.code)
@@ -1,22 +1,149 @@
 from datetime import timedelta
 import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from threading import Lock
 
+import redis
 from hordeling.redis_ctrl import get_hordeling_db, is_redis_up, get_all_redis_db_servers
+from hordeling.ttl_cache import TTLCache
+from hordeling import metrics
+from hordeling.consts import REDIS_L1_SIZE, REDIS_L1_MAX_BYTES, REDIS_L1_TTL_SECONDS, REDIS_LOCK_STRIPES, REDIS_WRITE_QUORUM, REDIS_RETRY_SECONDS
 from loguru import logger
 
-locks = {}
+# A fixed set of locks shared between keys, so that locking arbitrary keys doesn't grow without bounds
+locks = [Lock() for _ in range(REDIS_LOCK_STRIPES)]
+lease_lock = Lock()
+local_leases = {}
+
+# Only deletes the lease if we're still the ones holding it
+RELEASE_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+else
+    return 0
+end
+"""
 
 hordeling_r = None
 all_hordeling_redis = []
-logger.init("Horde Redis", status="Connecting")
-if is_redis_up():
-    hordeling_r = get_hordeling_db()
-    all_hordeling_redis = get_all_redis_db_servers()
-    logger.init_ok("Horde Redis", status="Connected")
-else:
-    logger.init_err("Horde Redis", status="Failed")
+redis_initialized = False
+redis_init_lock = Lock()
+# Sends writes to all the servers at the same time, when we have more than one
+write_executor = None
+# The index of each server which failed us, along with when we should try it again
+server_retry_at = {}
+
+def init_hordeling_redis():
+    """Connects to redis the first time we need it, instead of when we're imported"""
+    global hordeling_r, all_hordeling_redis, redis_initialized, write_executor
+    if redis_initialized:
+        return
+    with redis_init_lock:
+        if redis_initialized:
+            return
+        logger.init("Horde Redis", status="Connecting")
+        if is_redis_up():
+            hordeling_r = get_hordeling_db()
+            all_hordeling_redis = get_all_redis_db_servers()
+            if len(all_hordeling_redis) > 1:
+                write_executor = ThreadPoolExecutor(max_workers=len(all_hordeling_redis) * 8, thread_name_prefix="redis_write")
+            logger.init_ok("Horde Redis", status=f"Connected to {len(all_hordeling_redis)} servers")
+        else:
+            logger.init_err("Horde Redis", status="Failed")
+        redis_initialized = True
+
+
+def get_write_quorum():
+    """How many servers need to have a write, before we consider it done. By default, the majority"""
+    if REDIS_WRITE_QUORUM > 0:
+        return min(REDIS_WRITE_QUORUM, len(all_hordeling_redis))
+    return len(all_hordeling_redis) // 2 + 1
+
+
+def get_servers_by_health():
+    """Returns the indexes of all servers, with those which recently failed us at the end"""
+    now = time.monotonic()
+    healthy = [index for index in range(len(all_hordeling_redis)) if server_retry_at.get(index, 0) <= now]
+    failed = [index for index in range(len(all_hordeling_redis)) if server_retry_at.get(index, 0) > now]
+    return healthy + failed
+
+
+def mark_server_failed(index, err):
+    if server_retry_at.get(index, 0) <= time.monotonic():
+        logger.warning(f"Redis server {index} failed, skipping it for {REDIS_RETRY_SECONDS} seconds: {err}")
+    server_retry_at[index] = time.monotonic() + REDIS_RETRY_SECONDS
+
+
+def run_on_server(index, commands):
+    """Runs the commands on the server in a single pipeline
+    Returns the results, or None if the server could not be reached
+    """
+    try:
+        pipeline = all_hordeling_redis[index].pipeline(transaction=False)
+        commands(pipeline)
+        results = pipeline.execute()
+    except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as err:
+        mark_server_failed(index, err)
+        return None
+    server_retry_at.pop(index, None)
+    return results
+
 
+def get_write_servers():
+    """Returns the indexes of the servers a write goes to, along with how many of them need to have it"""
+    quorum = get_write_quorum()
+    indexes = get_servers_by_health()
+    healthy_count = len([index for index in indexes if server_retry_at.get(index, 0) <= time.monotonic()])
+    # If too many servers have failed to reach a quorum, we try them all again instead of giving up
+    if healthy_count >= quorum:
+        indexes = indexes[:healthy_count]
+    return indexes, quorum
+
+
+def write_to_all(commands):
+    """Sends the commands pipelined to all healthy servers at the same time
+    Returns as soon as the write quorum has them, leaving the slower servers to finish in the background
+    """
+    if not all_hordeling_redis:
+        return False
+    if write_executor is None:
+        return run_on_server(0, commands) is not None
+    indexes, quorum = get_write_servers()
+    futures = [write_executor.submit(run_on_server, index, commands) for index in indexes]
+    successes = 0
+    failures = 0
+    for future in as_completed(futures):
+        if future.result() is not None:
+            successes += 1
+        else:
+            failures += 1
+        if successes >= quorum:
+            return True
+        if failures > len(indexes) - quorum:
+            break
+    logger.error(f"Redis write only reached {successes} of the {quorum} servers it needed")
+    return False
+
+
+def read_with_failover(commands):
+    """Runs the commands on the first healthy server which answers
+    Returns the results, or None if no server could be reached
+    """
+    for index in get_servers_by_health():
+        results = run_on_server(index, commands)
+        if results is not None:
+            return results
+    return None
+
+
+def get_key_lock(key):
+    return locks[hash(key) % len(locks)]
+
+
+# The in-process tier in front of redis. Like the local redis tier, it only holds values very briefly
+local_values = TTLCache(REDIS_L1_SIZE, REDIS_L1_TTL_SECONDS, maxbytes=REDIS_L1_MAX_BYTES)
 
 horde_local_r = None
 # logger.init("Horde Local Redis", status="Connecting")
@@ -26,15 +153,24 @@ horde_local_r = None
 # else:
 #     logger.init_err("Horde Local Redis", status="Failed")
 
+def remember_locally(key, value, seconds=REDIS_L1_TTL_SECONDS):
+    # Values are only cached while redis is there, as everything has its own fallback when it is not
+    if hordeling_r is None:
+        return
+    local_values.set(key, value, ttl=min(seconds, REDIS_L1_TTL_SECONDS))
+
+
 def hordeling_r_set(key, value):
-    for hr in all_hordeling_redis:
-        hr.set(key, value)
+    init_hordeling_redis()
+    write_to_all(lambda pipeline: pipeline.set(key, value))
+    remember_locally(key, value)
     if horde_local_r:
         horde_local_r.setex(key, timedelta(10), value)
 
 def hordeling_r_setex(key, expiry, value):
-    for hr in all_hordeling_redis:
-        hr.setex(key, expiry, value)
+    init_hordeling_redis()
+    write_to_all(lambda pipeline: pipeline.setex(key, expiry, value))
+    remember_locally(key, value, expiry.total_seconds())
     # We don't keep local cache for more than 5 seconds
     if expiry > timedelta(5):
         expiry = timedelta(5)
@@ -42,6 +178,14 @@ def hordeling_r_setex(key, expiry, value):
         horde_local_r.setex(key, expiry, value)
 
 
+def hordeling_r_delete(key):
+    init_hordeling_redis()
+    write_to_all(lambda pipeline: pipeline.delete(key))
+    local_values.delete(key)
+    if horde_local_r:
+        horde_local_r.delete(key)
+
+
 def hordeling_r_setex_json(key, expiry, value):
     """Same as hordeling_r_setex()
     but also converts the python builtin value to json
@@ -49,42 +193,58 @@ def hordeling_r_setex_json(key, expiry, value):
     hordeling_r_setex(key, expiry, json.dumps(value))
 
 
+def hordeling_r_set_json(key, value):
+    """Same as hordeling_r_set()
+    but also converts the python builtin value to json
+    """
+    hordeling_r_set(key, json.dumps(value))
+
+
 def hordeling_r_local_set_to_json(key, value):
     if horde_local_r:
-        if key not in locks:
-            locks[key] = Lock()
-        locks[key].acquire()
-        try:
-            horde_local_r.set(key, json.dumps(value))
-        except Exception as err:
-            logger.error(f"Something went wrong when setting local redis: {e}")
-        locks[key].release()
+        with get_key_lock(key):
+            try:
+                horde_local_r.set(key, json.dumps(value))
+            except Exception as err:
+                logger.error(f"Something went wrong when setting local redis: {err}")
 
 def horde_local_setex_to_json(key, seconds, value):
     if horde_local_r:
-        if key not in locks:
-            locks[key] = Lock()
-        locks[key].acquire()
-        try:
-            horde_local_r.setex(key, timedelta(seconds=seconds), json.dumps(value))
-        except Exception as err:
-            logger.error(f"Something went wrong when setting local redis: {e}")
-        locks[key].release()
+        with get_key_lock(key):
+            try:
+                horde_local_r.setex(key, timedelta(seconds=seconds), json.dumps(value))
+            except Exception as err:
+                logger.error(f"Something went wrong when setting local redis: {err}")
 
-def hordeling_r_get(key):
-    """Retrieves the value from local redis if it exists
+def hordeling_r_get(key, use_cache=True):
+    """Retrieves the value from our process or local redis if it exists
     If it doesn't exist retrieves it from remote redis
-    If it exists in remote redis, also stores it in local redis
+    If it exists in remote redis, also stores it in our process and local redis
+
+    :param use_cache: If False, always asks remote redis, for values which other processes keep changing
     """
+    init_hordeling_redis()
+    if use_cache:
+        value = local_values.get(key)
+        metrics.record_cache("redis_l1", value is not None)
+        if value is not None:
+            return value
     value = None
     if horde_local_r:
         # if key in ["worker_cache","worker_cache_privileged"]:
         #     logger.warning(f"Got {key} from Local")
         value = horde_local_r.get(key)
     if value is None and hordeling_r:
-        value = hordeling_r.get(key)
+        # We ask for the TTL in the same round-trip, so that we never cache a value for longer than redis does
+        results = read_with_failover(lambda pipeline: pipeline.get(key).ttl(key))
+        if results is None:
+            return None
+        value, remote_ttl = results
+        if value is not None and remote_ttl != 0:
+            # A negative TTL means the key never expires
+            remember_locally(key, value, remote_ttl if remote_ttl > 0 else REDIS_L1_TTL_SECONDS)
         if value is not None and horde_local_r is not None:
-            ttl = hordeling_r.ttl(key)
+            ttl = remote_ttl
             if ttl > 5:
                 ttl = 5
             if ttl <= 0:
@@ -94,11 +254,67 @@ def hordeling_r_get(key):
                 horde_local_r.setex(key, timedelta(seconds=abs(ttl)), value)
     return value
 
-def hordeling_r_get_json(key):
+def hordeling_r_get_json(key, use_cache=True):
     """Same as hordeling_r_get()
     but also converts the json to python built-ins
     """
-    value = hordeling_r_get(key)
+    value = hordeling_r_get(key, use_cache)
     if value is None:
         return None
     return json.loads(value)
+
+
+def acquire_local_lease(key, token, seconds):
+    with lease_lock:
+        current = local_leases.get(key)
+        if current is not None and current[1] > time.monotonic():
+            return None
+        local_leases[key] = (token, time.monotonic() + seconds)
+    return token
+
+def release_local_lease(key, token):
+    with lease_lock:
+        current = local_leases.get(key)
+        if current is not None and current[0] == token:
+            del local_leases[key]
+
+def local_lease_exists(key):
+    with lease_lock:
+        current = local_leases.get(key)
+        return current is not None and current[1] > time.monotonic()
+
+def hordeling_r_acquire_lease(key, seconds):
+    """Attempts to take an exclusive lease on the key for the specified amount of seconds
+    Returns the lease token if we acquired it, or None if someone else is holding it
+    If redis is not available, the lease is only valid for this process
+    """
+    init_hordeling_redis()
+    token = str(uuid.uuid4())
+    if hordeling_r:
+        try:
+            if hordeling_r.set(key, token, nx=True, ex=seconds):
+                return token
+            return None
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as err:
+            logger.warning(f"Redis failed when acquiring lease {key}, only leasing it in this process: {err}")
+    return acquire_local_lease(key, token, seconds)
+
+def hordeling_r_release_lease(key, token):
+    init_hordeling_redis()
+    if hordeling_r:
+        try:
+            hordeling_r.eval(RELEASE_LEASE_SCRIPT, 1, key, token)
+        except Exception as err:
+            logger.error(f"Something went wrong when releasing lease {key}: {err}")
+    # The lease might have been taken in this process while redis was down
+    release_local_lease(key, token)
+
+def hordeling_r_lease_exists(key):
+    init_hordeling_redis()
+    if hordeling_r:
+        try:
+            if hordeling_r.exists(key) > 0:
+                return True
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError) as err:
+            logger.warning(f"Redis failed when checking lease {key}, only checking this process: {err}")
+    return local_lease_exists(key)
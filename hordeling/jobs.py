@@ -0,0 +1,223 @@
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from threading import Lock
+
+from loguru import logger
+from hordeling import hordeling_redis
+from hordeling import metrics
+from hordeling import r2
+from hordeling import content_index
+from hordeling import exceptions as e
+from hordeling.consts import (
+    CONVERSION_WORKERS, JOB_EXPIRY_SECONDS, CONVERSION_MAX_JOBS, CONVERSION_MEMORY_BUDGET_BYTES,
+    CONVERSION_MEMORY_FACTOR, CONVERSION_DEFAULT_SIZE_BYTES, CONVERSION_RETRY_AFTER_SECONDS,
+)
+
+JOB_STATUSES = ["queued", "waiting", "converting", "uploading", "done", "failed"]
+FINISHED_STATUSES = ["done", "failed"]
+
+executor = None
+executor_lock = Lock()
+# Used when redis is not available, so that this node can still report on its own jobs
+local_jobs = {}
+local_job_ids = {}
+# The memory we expect each accepted job of this node to need, until it's finished
+admitted_jobs = {}
+admission_lock = Lock()
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            # We spawn instead of forking, as forking a process full of waitress threads is not safe
+            executor = ProcessPoolExecutor(
+                max_workers=CONVERSION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            logger.init_ok("Conversion Workers", status=f"{CONVERSION_WORKERS} Processes")
+    return executor
+
+
+def get_job(job_id):
+    # The worker processes keep updating the job, so we never want a cached copy
+    job = hordeling_redis.hordeling_r_get_json(f"job:{job_id}", use_cache=False)
+    if job is None:
+        job = local_jobs.get(job_id)
+    return job
+
+
+def update_job(job_id, **kwargs):
+    job = get_job(job_id)
+    if job is None:
+        return
+    job.update(kwargs)
+    job["updated"] = time.time()
+    if job_id in local_jobs:
+        local_jobs[job_id] = job
+    hordeling_redis.hordeling_r_setex_json(f"job:{job_id}", timedelta(seconds=JOB_EXPIRY_SECONDS), job)
+
+
+def get_mapping_key(civitai_model):
+    return f"conversion_job:{civitai_model.get_conversion_id()}"
+
+
+def get_running_job(civitai_model):
+    """Returns the job which is already converting the model's pickletensor, or None
+    This can be a job started for another model with the same pickletensor
+    """
+    mapping_key = get_mapping_key(civitai_model)
+    existing_id = hordeling_redis.hordeling_r_get(mapping_key)
+    if existing_id is None:
+        existing_id = local_job_ids.get(mapping_key)
+    if existing_id is None:
+        return None
+    existing_job = get_job(existing_id)
+    if existing_job is None or existing_job["status"] in FINISHED_STATUSES:
+        return None
+    return existing_job
+
+
+def get_conversion_cost(civitai_model):
+    """Returns how many bytes of memory we expect the conversion of this model to need"""
+    size_bytes = CONVERSION_DEFAULT_SIZE_BYTES
+    if civitai_model.pickletensor_size_kb is not None:
+        size_bytes = int(civitai_model.pickletensor_size_kb * 1024)
+    return int(size_bytes * CONVERSION_MEMORY_FACTOR)
+
+
+def can_admit(cost):
+    if not admitted_jobs:
+        return True
+    if len(admitted_jobs) >= CONVERSION_MAX_JOBS:
+        return False
+    return sum(admitted_jobs.values()) + cost <= CONVERSION_MEMORY_BUDGET_BYTES
+
+
+def raise_busy(civitai_model):
+    metrics.conversion_admissions.inc("rejected")
+    raise e.ServiceUnavailable(
+        f"Too many conversions are running at the moment. Please try {civitai_model.name} again later",
+        retry_after=CONVERSION_RETRY_AFTER_SECONDS,
+    )
+
+
+def admit_job(job_id, civitai_model):
+    cost = get_conversion_cost(civitai_model)
+    with admission_lock:
+        if not can_admit(cost):
+            return False
+        admitted_jobs[job_id] = cost
+    metrics.conversion_admissions.inc("accepted")
+    metrics.conversion_reserved_bytes.inc(amount=cost)
+    return True
+
+
+def release_job(job_id):
+    with admission_lock:
+        cost = admitted_jobs.pop(job_id, None)
+    if cost is not None:
+        metrics.conversion_reserved_bytes.dec(amount=cost)
+
+
+def submit_conversion(civitai_model, charge=None):
+    """Queues the conversion of the model's pickletensor to a worker process
+    If a conversion for the same pickletensor is already running, returns that job instead
+    Raises e.ServiceUnavailable when this node already has as many conversions as it can take
+
+    :param charge: Optional callable which is only called for a new conversion, and can refuse it by raising.
+    It's called under the same lock we check for a running job and create the job with,
+    so that concurrent requests for the same pickletensor only charge once
+    """
+    mapping_key = get_mapping_key(civitai_model)
+    with hordeling_redis.get_key_lock(mapping_key):
+        existing_job = get_running_job(civitai_model)
+        if existing_job is not None:
+            return existing_job
+        job_id = str(uuid.uuid4())
+        if not admit_job(job_id, civitai_model):
+            raise_busy(civitai_model)
+        if charge is not None:
+            try:
+                charge()
+            except Exception:
+                release_job(job_id)
+                raise
+        now = time.time()
+        prune_local_jobs(now)
+        job = {
+            "id": job_id,
+            "model_id": civitai_model.model_id,
+            "name": civitai_model.name,
+            "safetensor_filename": civitai_model.get_safetensor_filename(),
+            "status": "queued",
+            "message": None,
+            "sha256": None,
+            "created": now,
+            "updated": now,
+        }
+        local_jobs[job["id"]] = job
+        local_job_ids[mapping_key] = job["id"]
+        hordeling_redis.hordeling_r_setex_json(f"job:{job['id']}", timedelta(seconds=JOB_EXPIRY_SECONDS), job)
+        hordeling_redis.hordeling_r_setex(mapping_key, timedelta(seconds=JOB_EXPIRY_SECONDS), job["id"])
+    metrics.conversion_jobs_in_flight.inc()
+    try:
+        future = get_executor().submit(run_conversion, job["id"], civitai_model)
+    except Exception:
+        metrics.conversion_jobs_in_flight.dec()
+        release_job(job["id"])
+        raise
+    future.add_done_callback(lambda f: finish_job(job["id"], mapping_key, job["safetensor_filename"], f))
+    logger.info(f"Queued conversion job {job['id']} for {civitai_model.name}")
+    return job
+
+
+def prune_local_jobs(now):
+    for job_id, job in list(local_jobs.items()):
+        if job["status"] in FINISHED_STATUSES and job["updated"] < now - JOB_EXPIRY_SECONDS:
+            local_jobs.pop(job_id, None)
+
+
+def finish_job(job_id, mapping_key, safetensor_filename, future):
+    metrics.conversion_jobs_in_flight.dec()
+    release_job(job_id)
+    try:
+        result = future.result()
+    except Exception as err:
+        result = {"status": "failed", "message": f"Conversion worker crashed: {err}"}
+    metrics.merge(result.pop("metrics", {}))
+    pickletensor_hash = result.pop("pickletensor_hash", None)
+    update_job(job_id, **result)
+    local_job_ids.pop(mapping_key, None)
+    if result["status"] == "done":
+        # The worker only reports done once the upload succeeded or R2 confirmed the file exists,
+        # but our own process may still remember it as missing, so we check it again next time
+        r2.forget_local_existence(result.get("safetensor_filename", safetensor_filename))
+        # and it may also still remember this pickletensor as never converted
+        content_index.forget_local_entry(pickletensor_hash)
+    if result["status"] == "failed":
+        logger.warning(f"Conversion job {job_id} failed: {result['message']}")
+
+
+def run_conversion(job_id, civitai_model):
+    """Runs inside the worker process
+    We never let exceptions escape, as ours cannot be pickled back to the main process
+    """
+    try:
+        civitai_model.convert_safetensor(progress=lambda status: update_job(job_id, status=status))
+        # The model may have been mapped to the safetensor of an identical pickletensor
+        result = {
+            "status": "done",
+            "sha256": civitai_model.get_sha256(),
+            "safetensor_filename": civitai_model.get_safetensor_key(),
+        }
+    except Exception as err:
+        message = getattr(err, "specific", None) or str(err)
+        result = {"status": "failed", "message": message}
+    # The metrics of this process are never scraped, so we send them back to the main process
+    result["metrics"] = metrics.export_and_reset()
+    result["pickletensor_hash"] = civitai_model.pickletensor_hash
+    return result
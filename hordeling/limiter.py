@@ -1,34 +1,97 @@
+import time
+
+from flask import g, request
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from limits import parse_many
+from limits.storage import MemoryStorage
+from limits.strategies import MovingWindowRateLimiter
 from hordeling.flask import APP
+from hordeling import exceptions as e
 from loguru import logger
-from .redis_ctrl import is_redis_up, ger_limiter_url
+from .redis_ctrl import ger_limiter_url, redis_connect_timeout, redis_socket_timeout
+from .consts import REQUEST_LIMIT, CONVERSION_LIMITS_PER_IP, CONVERSION_LIMITS_PER_CLIENT_AGENT, REDIS_RETRY_SECONDS
+
+# Clients which don't tell us who they are all share this agent, so it doesn't get a budget of its own
+DEFAULT_CLIENT_AGENT = "unknown:0:unknown"
+
+conversion_limits_per_ip = parse_many(CONVERSION_LIMITS_PER_IP)
+conversion_limits_per_client_agent = parse_many(CONVERSION_LIMITS_PER_CLIENT_AGENT)
+
+def restore_retry_after(response):
+    """flask-limiter sets Retry-After on every response, to when the request limit resets
+    Only our own errors and the limiter's 429 should have one, and ours should keep its value
+    It's registered before the limiter, so that it runs after the limiter adds its headers
+    """
+    retry_after = g.pop("retry_after", None)
+    if retry_after is not None:
+        response.headers["Retry-After"] = str(retry_after)
+    elif response.status_code != 429:
+        response.headers.pop("Retry-After", None)
+    return response
+
+
+APP.after_request(restore_retry_after)
 
-limiter = None
 # Very basic DOS prevention
-logger.init("Limiter Cache", status="Connecting")
-if is_redis_up():
-# if is_redis_up():
-    try:
-        limiter = Limiter(
-            APP,
-            key_func=get_remote_address,
-            storage_uri=ger_limiter_url(),
-            # storage_options={"connect_timeout": 30},
-            strategy="fixed-window", # or "moving-window"
-            default_limits=["90 per minute"],
-            headers_enabled=True
-        )
-        logger.init_ok("Limiter Cache", status="Connected")
-    except Exception as e:
-        logger.error(f"Failed to connect to Limiter Cache: {e}")
-
-# Allow local workstation run
-if limiter is None:
-    limiter = Limiter(
-        APP,
-        key_func=get_remote_address,
-        default_limits=["90 per minute"],
-        headers_enabled=True
-    )
-    logger.init_warn("Limiter Cache", status="Memory Only")
+# The moving window doesn't let a client spend two windows worth of requests around the edge of a window
+# Redis is only connected on first use, and flask-limiter counts in memory while it's unreachable
+limiter = Limiter(
+    APP,
+    key_func=get_remote_address,
+    storage_uri=ger_limiter_url(),
+    storage_options={"socket_connect_timeout": redis_connect_timeout, "socket_timeout": redis_socket_timeout},
+    strategy="moving-window",
+    default_limits=[REQUEST_LIMIT],
+    headers_enabled=True,
+    in_memory_fallback_enabled=True,
+)
+logger.init_ok("Limiter Cache", status="Connects on first use")
+# The limits we check ourselves, such as the conversion budgets, need their own fallback
+memory_limiter = MovingWindowRateLimiter(MemoryStorage())
+storage_retry_time = 0
+
+
+def call_limiter(method, limit, *identifiers):
+    """Calls the method of the rate limiter, such as hit or test, for this limit
+    While the limiter storage is unreachable, the limit is counted in memory instead
+    """
+    global storage_retry_time
+    if time.time() >= storage_retry_time:
+        try:
+            return getattr(limiter.limiter, method)(limit, *identifiers)
+        except Exception as err:
+            logger.warning(f"Limiter storage is unreachable. Counting limits in memory for {REDIS_RETRY_SECONDS}s: {err}")
+            storage_retry_time = time.time() + REDIS_RETRY_SECONDS
+    return getattr(memory_limiter, method)(limit, *identifiers)
+
+
+def get_client_identity():
+    """Returns the IP and Client-Agent of the current request
+    We need them outside of the request context, as batches are resolved in other threads
+    """
+    return get_remote_address(), request.headers.get("Client-Agent", DEFAULT_CLIENT_AGENT)
+
+
+def get_conversion_budgets(client_ip, client_agent):
+    budgets = [(limit, "ip", client_ip) for limit in conversion_limits_per_ip]
+    if client_agent is not None and client_agent != DEFAULT_CLIENT_AGENT:
+        budgets += [(limit, "client_agent", client_agent) for limit in conversion_limits_per_client_agent]
+    return budgets
+
+
+def charge_conversion(client_ip, client_agent):
+    """Charges starting one conversion against the budgets of the client's IP and Client-Agent
+    Raises e.TooManyRequests when any of them is spent. A spent budget isn't charged, but the ones before it are
+    """
+    if not limiter.enabled:
+        return
+    for limit, kind, identity in get_conversion_budgets(client_ip, client_agent):
+        # Testing first and hitting after would let concurrent requests all pass the test
+        if not call_limiter("hit", limit, "conversion", kind, identity):
+            reset_time, _ = call_limiter("get_window_stats", limit, "conversion", kind, identity)
+            raise e.TooManyRequests(
+                f"You have started too many conversions ({limit} per {kind}). Please try again later",
+                log=f"Conversion budget of {kind} {identity} is spent: {limit}",
+                retry_after=max(1, int(reset_time - time.time())),
+            )
@@ -0,0 +1,69 @@
+import os
+from pathlib import Path
+from threading import Lock
+
+from loguru import logger
+from hordeling import metrics
+from hordeling.consts import LOCAL_CACHE_MAX_BYTES
+
+# Files which are still being written, which we should never evict
+IN_PROGRESS_SUFFIXES = [".part", ".tmp"]
+
+
+class LocalFileCache:
+    """Keeps the files in a directory under a byte budget by deleting the least recently used ones
+
+    The modification time of each file is used as its last use, so the recency is shared
+    between all processes using the same directory, and survives restarts
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+
+    def touch(self, filepath):
+        """Marks the file as recently used. Returns False if the file is not in the cache"""
+        try:
+            os.utime(filepath)
+        except FileNotFoundError:
+            metrics.record_cache("local_files", False)
+            return False
+        metrics.record_cache("local_files", True)
+        return True
+
+    def add(self, filepath):
+        """Records a newly written file and evicts older ones if we're over budget"""
+        os.utime(filepath)
+        self.evict(keep=Path(filepath))
+
+    def remove(self, filepath):
+        Path(filepath).unlink(missing_ok=True)
+
+    def evict(self, keep=None):
+        with self.lock:
+            files = []
+            total_bytes = 0
+            for root, _, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    filepath = Path(root) / filename
+                    try:
+                        stat = filepath.stat()
+                    except FileNotFoundError:
+                        continue
+                    total_bytes += stat.st_size
+                    if filepath.suffix in IN_PROGRESS_SUFFIXES or filepath == keep:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, filepath))
+            if total_bytes <= self.max_bytes:
+                return
+            files.sort()
+            for _, size, filepath in files:
+                if total_bytes <= self.max_bytes:
+                    break
+                self.remove(filepath)
+                total_bytes -= size
+                logger.debug(f"Evicted {filepath} from the local model cache")
+
+
+models_cache = LocalFileCache("models", LOCAL_CACHE_MAX_BYTES)
@@ -0,0 +1,163 @@
+"""Lightweight prometheus metrics, rendered in the prometheus text format on /metrics
+
+Recording a value only takes a lock and a dict update, so it is cheap enough for the hot path.
+Worker processes send their counters and histograms back with each job result, see export_and_reset()
+"""
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+registry = []
+
+
+def format_labels(label_names, label_values):
+    if not label_names:
+        return ""
+    pairs = [f'{name}="{value}"' for name, value in zip(label_names, label_values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        return [f"{self.name}{format_labels(self.label_names, labels)} {value}" for labels, value in values]
+
+    def export(self):
+        with self.lock:
+            state = [[list(labels), value] for labels, value in self.values.items()]
+            self.values = {}
+        return state
+
+    def merge(self, state):
+        for labels, value in state:
+            self.inc(*labels, amount=value)
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self.lock:
+            self.values[label_values] = value
+
+    # Gauges describe the state of their own process, so they're never sent elsewhere
+    def export(self):
+        return []
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = list(buckets)
+        # For each set of labels, the count per bucket (plus +Inf), the sum, and the total count
+        self.values = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def observe(self, *label_values, value):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][bucket] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock:
+            values = [(labels, list(entry[0]), entry[1], entry[2]) for labels, entry in self.values.items()]
+        lines = []
+        label_names = self.label_names + ("le",)
+        for labels, bucket_counts, total, count in values:
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets + ["+Inf"], bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(label_names, labels + (upper_bound,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {count}")
+        return lines
+
+    def export(self):
+        with self.lock:
+            state = [[list(labels), entry] for labels, entry in self.values.items()]
+            self.values = {}
+        return state
+
+    def merge(self, state):
+        with self.lock:
+            for labels, (bucket_counts, total, count) in state:
+                labels = tuple(labels)
+                entry = self.values.get(labels)
+                if entry is None:
+                    entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                entry[0] = [current + new for current, new in zip(entry[0], bucket_counts)]
+                entry[1] += total
+                entry[2] += count
+
+
+stage_seconds = Histogram("hordeling_stage_seconds", "How long each stage of serving and converting a model takes", ["stage"])
+cache_requests = Counter("hordeling_cache_requests_total", "Lookups in each of our cache layers", ["cache", "result"])
+bytes_transferred = Counter("hordeling_bytes_transferred_total", "Bytes downloaded and uploaded", ["direction", "service"])
+conversions_in_flight = Gauge("hordeling_conversions_in_flight", "Conversions running in this process")
+conversion_jobs_in_flight = Gauge("hordeling_conversion_jobs_in_flight", "Conversion jobs queued or running in the worker processes")
+conversion_reserved_bytes = Gauge("hordeling_conversion_reserved_bytes", "Memory the accepted conversion jobs are expected to need")
+conversion_admissions = Counter("hordeling_conversion_admissions_total", "Conversion jobs we accepted or turned away", ["result"])
+
+
+@contextmanager
+def time_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(stage, value=time.perf_counter() - start)
+
+
+def record_cache(cache, hit):
+    cache_requests.inc(cache, "hit" if hit else "miss")
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.description}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def export_and_reset():
+    """Returns everything recorded in this process since the last call, so that it can be merged elsewhere"""
+    return {metric.name: metric.export() for metric in registry}
+
+
+def merge(state):
+    for metric in registry:
+        if metric.name in state and not isinstance(metric, Gauge):
+            metric.merge(state[metric.name])
@@ -0,0 +1,83 @@
+from datetime import timedelta
+
+from loguru import logger
+from hordeling import hordeling_redis
+from hordeling import metrics
+from hordeling import exceptions as e
+from hordeling.steps import call, run
+from hordeling.ttl_cache import TTLCache
+from hordeling.consts import NEGATIVE_CACHE_TTLS, NEGATIVE_CACHE_LRU_SIZE
+
+FAILURE_EXCEPTIONS = {
+    400: e.BadRequest,
+    404: e.NotFound,
+    503: e.ServiceUnavailable,
+}
+
+# The process-local tier in front of redis
+local_failures = TTLCache(NEGATIVE_CACHE_LRU_SIZE, max(NEGATIVE_CACHE_TTLS.values()))
+
+
+def record_failure(model_id, failure, code, message, file_id=None):
+    """Remembers why this model failed, for as long as this kind of failure is configured for
+
+    :param failure: The kind of failure, which needs to be one of NEGATIVE_CACHE_TTLS
+    :param code: The status code we respond with while we remember the failure
+    :param file_id: The file which caused the failure, if any. A new file clears the failure
+    """
+    ttl = NEGATIVE_CACHE_TTLS[failure]
+    entry = {
+        "failure": failure,
+        "code": code,
+        "message": message,
+        "file_id": file_id,
+    }
+    local_failures.set(str(model_id), entry, ttl=ttl)
+    hordeling_redis.hordeling_r_setex_json(f"negative:{model_id}", timedelta(seconds=ttl), entry)
+
+
+def clear_failure(model_id):
+    local_failures.delete(str(model_id))
+    hordeling_redis.hordeling_r_delete(f"negative:{model_id}")
+
+
+def get_known_failure(model_id, file_ids=None):
+    """Returns the remembered failure for this model, if it still applies
+
+    Failures caused by a specific file only apply once we know the ids of the model's current files
+    and are forgotten as soon as the file which caused them is gone
+    """
+    return run(get_known_failure_steps(model_id, file_ids))
+
+
+def get_known_failure_steps(model_id, file_ids=None):
+    entry = local_failures.get(str(model_id))
+    if entry is None:
+        entry = yield call(hordeling_redis.hordeling_r_get_json, f"negative:{model_id}")
+        if entry is None:
+            metrics.record_cache("negative", False)
+            return None
+        local_failures.set(str(model_id), entry, ttl=NEGATIVE_CACHE_TTLS[entry["failure"]])
+    if entry["file_id"] is None:
+        metrics.record_cache("negative", True)
+        return entry
+    if file_ids is None:
+        return None
+    if str(entry["file_id"]) not in {str(file_id) for file_id in file_ids}:
+        logger.debug(f"Model {model_id} has a new file, so we forget its {entry['failure']} failure")
+        yield call(clear_failure, model_id)
+        metrics.record_cache("negative", False)
+        return None
+    metrics.record_cache("negative", True)
+    return entry
+
+
+def raise_if_known_failure(model_id, file_ids=None):
+    raise_for_failure(get_known_failure(model_id, file_ids))
+
+
+def raise_for_failure(entry):
+    if entry is None:
+        return
+    exception = FAILURE_EXCEPTIONS.get(entry["code"], e.BadRequest)
+    raise exception(entry["message"])
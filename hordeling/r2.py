@@ -1,13 +1,51 @@
+import json
 import os
+import time
+from datetime import timedelta
+from threading import Lock
 from loguru import logger
-import boto3
-from botocore.client import Config
 from botocore.exceptions import ClientError
+from hordeling import hordeling_redis
+from hordeling import metrics
+from hordeling.steps import call, run
+from hordeling.ttl_cache import TTLCache
+from hordeling.consts import WSGI_THREADS, HTTP_RETRIES, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from hordeling.consts import R2_EXISTS_TTL_SECONDS, R2_MISSING_TTL_SECONDS, R2_URL_EXPIRY_SECONDS, R2_URL_MIN_REMAINING_SECONDS, R2_CACHE_SIZE
 
 r2_account = os.getenv("R2_SAFETENSORS_ACCOUNT", "https://a223539ccf6caa2d76459c9727d276e6.r2.cloudflarestorage.com")
 r2_bucket = os.getenv("R2_TRANSIENT_BUCKET", "safetensors")
 
-s3_client = boto3.client('s3', endpoint_url=r2_account,  config=Config(signature_version='s3v4'))
+s3_client = None
+s3_client_lock = Lock()
+
+def get_s3_client():
+    """Creates the boto3 client the first time we need it, as creating it is slow and needs plenty of memory"""
+    global s3_client
+    if s3_client is not None:
+        return s3_client
+    with s3_client_lock:
+        if s3_client is None:
+            import boto3
+            from botocore.client import Config
+            s3_client = boto3.client(
+                's3',
+                endpoint_url=r2_account,
+                config=Config(
+                    signature_version='s3v4',
+                    # Match the waitress threads, so that every thread can keep its connection alive
+                    max_pool_connections=WSGI_THREADS,
+                    retries={'max_attempts': HTTP_RETRIES, 'mode': 'standard'},
+                    connect_timeout=HTTP_CONNECT_TIMEOUT,
+                    read_timeout=HTTP_READ_TIMEOUT,
+                    tcp_keepalive=True,
+                ),
+            )
+    return s3_client
+
+# Process-local tiers in front of redis. The existence cache stores booleans
+# and the url cache stores dicts with the url and its expiry timestamp
+existence_cache = TTLCache(R2_CACHE_SIZE, R2_EXISTS_TTL_SECONDS)
+url_cache = TTLCache(R2_CACHE_SIZE, R2_URL_EXPIRY_SECONDS)
 
 @logger.catch(reraise=True)
 def generate_presigned_url(client, client_method, method_parameters, expires_in = 1800):
@@ -34,33 +72,200 @@ def generate_presigned_url(client, client_method, method_parameters, expires_in
     return url
 
 def generate_safetensor_download_url(filename):
-    client = s3_client
+    return get_safetensor_download_url_entry(filename)["url"]
+
+def get_safetensor_download_url_entry(filename):
+    """Returns a dict with a presigned download url for the safetensor and the timestamp it expires on
+    Urls are reused until they get close to expiring
+    """
+    return run(get_safetensor_download_url_entry_steps(filename))
+
+def get_safetensor_download_url_entry_steps(filename):
+    entry = url_cache.get(filename)
+    metrics.record_cache("r2_url_local", entry is not None)
+    if entry is None:
+        entry = yield call(hordeling_redis.hordeling_r_get_json, f"r2_url:{filename}")
+        metrics.record_cache("r2_url_redis", entry is not None)
+    if entry is not None and entry["expires"] - time.time() > R2_URL_MIN_REMAINING_SECONDS:
+        url_cache.set(filename, entry, ttl=entry["expires"] - time.time() - R2_URL_MIN_REMAINING_SECONDS)
+        return entry
+    client = get_s3_client()
     # if not file_exists(client,  f"{procgen_id}.webp"):
     #     client = old_r2
-    return generate_presigned_url(
-        client = client,
-        client_method = "get_object",
-        method_parameters = {'Bucket': r2_bucket, 'Key': filename},
-        expires_in = 1800
-    )
-
-def upload_safetensor(civitai_model):
+    with metrics.time_stage("r2_sign"):
+        entry = {
+            "url": generate_presigned_url(
+                client = client,
+                client_method = "get_object",
+                method_parameters = {'Bucket': r2_bucket, 'Key': filename},
+                expires_in = R2_URL_EXPIRY_SECONDS
+            ),
+            "expires": time.time() + R2_URL_EXPIRY_SECONDS,
+        }
+    reuse_seconds = R2_URL_EXPIRY_SECONDS - R2_URL_MIN_REMAINING_SECONDS
+    if reuse_seconds > 0:
+        url_cache.set(filename, entry, ttl=reuse_seconds)
+        yield call(hordeling_redis.hordeling_r_setex_json, f"r2_url:{filename}", timedelta(seconds=reuse_seconds), entry)
+    return entry
+
+def remember_existence(filename, exists):
+    run(remember_existence_steps(filename, exists))
+
+def remember_existence_steps(filename, exists):
+    ttl = R2_EXISTS_TTL_SECONDS if exists else R2_MISSING_TTL_SECONDS
+    existence_cache.set(filename, exists, ttl=ttl)
+    yield call(hordeling_redis.hordeling_r_setex, f"r2_exists:{filename}", timedelta(seconds=ttl), "1" if exists else "0")
+
+def forget_local_existence(filename):
+    """Makes this process check the existence of the safetensor again, instead of trusting what it remembers"""
+    existence_cache.delete(filename)
+
+def forget_download_url(filename):
+    url_cache.delete(filename)
+    hordeling_redis.hordeling_r_delete(f"r2_url:{filename}")
+
+def upload_safetensor(civitai_model, sha256=None):
+    # We store the hash along with the object, so that we never need to download it again to find it
+    extra_args = None
+    if sha256 is not None:
+        extra_args = {"Metadata": {"sha256": sha256}}
     try:
-        response = s3_client.upload_file(
-            civitai_model.get_safetensor_filepath(), r2_bucket, civitai_model.get_safetensor_filename()
-        )
+        with metrics.time_stage("r2_upload"):
+            response = get_s3_client().upload_file(
+                civitai_model.get_safetensor_filepath(), r2_bucket, civitai_model.get_safetensor_filename(),
+                ExtraArgs=extra_args,
+            )
     except ClientError as e:
         logger.error(f"Error encountered while uploading metadata {civitai_model.get_safetensor_filename()}: {e}")
         return False
+    metrics.bytes_transferred.inc("upload", "r2", amount=os.path.getsize(civitai_model.get_safetensor_filepath()))
+    remember_existence(civitai_model.get_safetensor_filename(), True)
+    forget_download_url(civitai_model.get_safetensor_filename())
+    return True
+
+def upload_safetensor_bytes(filename, safetensor_bytes, sha256=None):
+    """Same as upload_safetensor() for a safetensor which only exists in memory"""
+    metadata = {}
+    if sha256 is not None:
+        metadata["sha256"] = sha256
+    try:
+        with metrics.time_stage("r2_upload"):
+            get_s3_client().put_object(
+                Bucket=r2_bucket,
+                Key=filename,
+                Body=safetensor_bytes,
+                Metadata=metadata,
+            )
+    except ClientError as e:
+        logger.error(f"Error encountered while uploading {filename}: {e}")
+        return False
+    metrics.bytes_transferred.inc("upload", "r2", amount=len(safetensor_bytes))
+    remember_existence(filename, True)
+    forget_download_url(filename)
+    return True
+
+def get_safetensor_sha256(filename):
+    """Returns the sha256 stored in the metadata of the safetensor object
+    or None if the object doesn't exist or was uploaded without one
+    """
+    return run(get_safetensor_sha256_steps(filename))
+
+def get_safetensor_sha256_steps(filename):
+    metadata = yield call(head_safetensor, filename)
+    if metadata is None or metadata is False:
+        return None
+    yield from remember_existence_steps(filename, True)
+    return metadata.get("sha256")
+
+def set_safetensor_sha256(filename, sha256):
+    """Adds the sha256 to the metadata of an already uploaded safetensor"""
+    try:
+        get_s3_client().copy_object(
+            Bucket=r2_bucket,
+            Key=filename,
+            CopySource={'Bucket': r2_bucket, 'Key': filename},
+            Metadata={"sha256": sha256},
+            MetadataDirective="REPLACE",
+        )
+    except ClientError as e:
+        logger.error(f"Error encountered while storing the sha256 of {filename}: {e}")
+        return False
+    return True
+
+def get_content_index_key(pickletensor_hash):
+    return f"content_index/{pickletensor_hash}.json"
+
+def get_content_index_object(pickletensor_hash):
+    """Returns the content index entry we stored in R2 for this pickletensor hash
+    or None if there isn't one. Returns False if R2 could not tell us
+    """
+    try:
+        with metrics.time_stage("r2_index_get"):
+            response = get_s3_client().get_object(Bucket=r2_bucket, Key=get_content_index_key(pickletensor_hash))
+            return json.loads(response["Body"].read())
+    except ClientError as e:
+        if e.response['Error']['Code'] in ("NoSuchKey", "404"):
+            return None
+        logger.error(f"Error encountered while reading the content index of {pickletensor_hash}: {e}")
+        return False
+
+def put_content_index_object(pickletensor_hash, entry):
+    try:
+        with metrics.time_stage("r2_index_put"):
+            get_s3_client().put_object(
+                Bucket=r2_bucket,
+                Key=get_content_index_key(pickletensor_hash),
+                Body=json.dumps(entry).encode(),
+                ContentType="application/json",
+            )
+    except ClientError as e:
+        logger.error(f"Error encountered while storing the content index of {pickletensor_hash}: {e}")
+        return False
+    return True
 
 def check_file(client, bucket, filename):
     try:
-        return client.head_object(Bucket=bucket, Key=filename)
+        with metrics.time_stage("r2_head"):
+            return client.head_object(Bucket=bucket, Key=filename)
     except ClientError as e:
         return int(e.response['Error']['Code']) != 404
 
-def check_safetensor(filename):
-    return type(check_file(s3_client, r2_bucket, filename)) == dict
+def head_safetensor(filename):
+    """Returns the user metadata of the safetensor object
+    or None if R2 told us it doesn't exist, and False if R2 could not tell us
+    """
+    head = check_file(get_s3_client(), r2_bucket, filename)
+    if type(head) == dict:
+        return head.get("Metadata", {})
+    # check_file returns True for errors other than 404
+    if head is False:
+        return None
+    return False
+
+def check_safetensor(filename, use_cache=True):
+    """Returns True if the safetensor exists in R2
+    Set use_cache to False when we need to be sure, such as before starting a conversion
+    """
+    return run(check_safetensor_steps(filename, use_cache))
+
+def check_safetensor_steps(filename, use_cache=True):
+    if use_cache:
+        exists = existence_cache.get(filename)
+        metrics.record_cache("r2_exists_local", exists is not None)
+        if exists is not None:
+            return exists
+        cached = yield call(hordeling_redis.hordeling_r_get, f"r2_exists:{filename}")
+        metrics.record_cache("r2_exists_redis", cached is not None)
+        if cached is not None:
+            exists = cached == "1"
+            existence_cache.set(filename, exists, ttl=R2_EXISTS_TTL_SECONDS if exists else R2_MISSING_TTL_SECONDS)
+            return exists
+    metadata = yield call(head_safetensor, filename)
+    if metadata is False:
+        # We only remember that the file is missing when R2 told us so
+        return False
+    yield from remember_existence_steps(filename, metadata is not None)
+    return metadata is not None
 
 def file_exists(client, bucket, filename):
     # If the return of check_file is an int, it means it encountered an error
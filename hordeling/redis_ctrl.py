@@ -7,31 +7,35 @@ from loguru import logger
 
 redis_hostname = os.getenv('REDIS_IP', "localhost")
 redis_port = 6379
+# We don't want an unreachable redis to block our startup for long
+redis_connect_timeout = float(os.getenv("REDIS_CONNECT_TIMEOUT", 1))
+# And a server which stops answering should be failed over instead of waited on
+redis_socket_timeout = float(os.getenv("REDIS_SOCKET_TIMEOUT", 2))
 redis_address = f"redis://{redis_hostname}:{redis_port}"
 
 hordeling_db = 0
 limiter_db = 1
-cache_db = 2
 
 def is_redis_up() -> bool:
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(redis_connect_timeout)
         return s.connect_ex((redis_hostname, redis_port)) == 0
 
 def is_local_redis_up() -> bool:
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(redis_connect_timeout)
         return s.connect_ex(("127.0.0.1", 6379)) == 0
 
 def ger_limiter_url():
     return(f"{redis_address}/{limiter_db}")
 
-def ger_cache_url():
-    return(f"{redis_address}/{cache_db}")
-
 def get_hordeling_db():
     return redis.Redis(
         host=redis_hostname,
         port=redis_port,
         db = hordeling_db,
+        socket_connect_timeout=redis_connect_timeout,
+        socket_timeout=redis_socket_timeout,
         decode_responses=True)
 
 def get_local_hordeling_db():
@@ -46,17 +50,39 @@ def get_redis_db_server(server_ip):
         host=server_ip,
         port=redis_port,
         db = hordeling_db,
+        socket_connect_timeout=redis_connect_timeout,
+        socket_timeout=redis_socket_timeout,
         decode_responses=True)
 
+def get_redis_server_ips():
+    """The addresses of all the redis servers in the cluster, or only the loadbalancer if we have none"""
+    if not os.getenv("REDIS_SERVERS"):
+        return [redis_hostname]
+    try:
+        return [str(rs) for rs in json.loads(os.getenv("REDIS_SERVERS"))]
+    except Exception:
+        logger.error(f"Error setting up REDIS_SERVERS array. Falling back to loadbalancer.")
+        return [redis_hostname]
+
 def get_all_redis_db_servers():
     """An array of all the redis servers in the cluster
     We use this to always store the entries in all servers
     This allows redis to transparently failover.
     """
-    # Currently only local redis supported
-    return [get_hordeling_db()]
-    # try:
-    #     return [get_redis_db_server(rs) for rs in json.loads(os.getenv("REDIS_SERVERS"))]
-    # except:
-    #     logger.error(f"Error setting up REDIS_SERVERS array. Falling back to loadbalancer.")
-    #     return [get_hordeling_db()]
+    return [get_redis_db_server(rs) for rs in get_redis_server_ips()]
+
+def get_all_async_redis_db_servers():
+    """Same as get_all_redis_db_servers(), but with the non-blocking clients of the async serving mode
+    They are in the same order, so that both share the health of each server
+    """
+    import redis.asyncio as aioredis
+    return [
+        aioredis.Redis(
+            host=rs,
+            port=redis_port,
+            db = hordeling_db,
+            socket_connect_timeout=redis_connect_timeout,
+            socket_timeout=redis_socket_timeout,
+            decode_responses=True)
+        for rs in get_redis_server_ips()
+    ]
@@ -0,0 +1,85 @@
+"""Resolves the download details of embeddings, for both the blocking and the async serving modes"""
+from werkzeug.http import quote_etag
+
+from hordeling import exceptions as e
+from hordeling import jobs
+from hordeling import r2
+from hordeling import negative_cache
+from hordeling import etags
+from hordeling import response_cache
+from hordeling.civitai import CivitAIModel, retrieve_model_metadata_steps
+from hordeling.limiter import charge_conversion
+from hordeling.steps import call, run
+
+
+def serve_embedding(model_id: str, client_identity):
+    """Same as resolve_embedding(), but serves the cached response of the model when we have one
+    Stale responses are refreshed in the background
+    """
+    return run(serve_embedding_steps(model_id, client_identity))
+
+
+def serve_embedding_steps(model_id: str, client_identity):
+    cached_response = yield from response_cache.get_cached_response_steps(model_id, lambda: refresh_embedding(model_id))
+    if cached_response is not None:
+        return cached_response
+    return (yield from resolve_embedding_steps(model_id, client_identity))
+
+
+def resolve_embedding(model_id: str, client_identity):
+    """Ensures the model is available as a safetensor and returns its download details
+    Only starting a new conversion is charged against the conversion budgets of the client_identity
+
+    Returns a tuple of the response dict, the status code and the headers, or raises one of our exceptions
+    """
+    return run(resolve_embedding_steps(model_id, client_identity))
+
+
+def refresh_embedding(model_id: str):
+    """Same as resolve_embedding() for refreshing a cached response in the background
+    It never starts a conversion, so nobody is charged for it. A missing safetensor raises e.NotFound instead
+    """
+    return run(resolve_embedding_steps(model_id))
+
+
+def resolve_embedding_steps(model_id: str, client_identity=None):
+    if not model_id.isdigit():
+        raise e.BadRequest("You can only pass CivitAI mdoel IDs")
+    negative_cache.raise_for_failure((yield from negative_cache.get_known_failure_steps(model_id)))
+    metadata, rc, fault_msg = yield from retrieve_model_metadata_steps(model_id)
+    if metadata is None:
+        if rc == 404:
+            raise e.NotFound(fault_msg)
+        raise e.ServiceUnavailable(fault_msg)
+    model: CivitAIModel = CivitAIModel(model_id, model_metadata=metadata)
+    if not model.is_valid():
+        raise e.ServiceUnavailable(model.fault_msg)
+    negative_cache.raise_for_failure((yield from negative_cache.get_known_failure_steps(model_id, model.file_ids)))
+    if not model.is_safe:
+        message = f"{model.name} has not passed the CivitAI pickle scanner succesfully"
+        yield call(negative_cache.record_failure, model_id, "unsafe", 400, message, model.unsafe_file_id)
+        raise e.BadRequest(message)
+    if model.type != "TextualInversion":
+        message = f"{model.name} is not an Embedding / Textual Inversion"
+        yield call(negative_cache.record_failure, model_id, "wrong_type", 400, message)
+        raise e.BadRequest(message)
+    if model.safetensor_url is not None:
+        download = {"url": model.safetensor_url, "expires": None}
+    else:
+        safetensor_key = yield from model.get_safetensor_key_steps()
+        if not (yield from r2.check_safetensor_steps(safetensor_key)):
+            if client_identity is None:
+                raise e.NotFound(f"The safetensor of {model.name} is missing")
+            job = yield call(jobs.submit_conversion, model, lambda: charge_conversion(*client_identity))
+            return {"job_id": job["id"]}, 202, {}
+        download = yield from r2.get_safetensor_download_url_entry_steps(safetensor_key)
+    sha256 = yield from model.get_sha256_steps()
+    if model.safetensor_url is None:
+        yield from model.index_safetensor_steps(safetensor_key, sha256)
+    etag = yield from etags.store_embedding_etag_steps(model_id, model.pickletensor_id, sha256, download["expires"])
+    result = {"url": download["url"]}
+    if sha256 is not None:
+        result["sha256"] = sha256
+    yield call(response_cache.store_response, model_id, model, result, etag, download["expires"])
+    return dict(result), 200, {"ETag": quote_etag(etag)}
+
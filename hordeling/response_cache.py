@@ -0,0 +1,172 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import Lock
+
+from loguru import logger
+from werkzeug.http import quote_etag
+
+from hordeling import hordeling_redis
+from hordeling import civitai_cache
+from hordeling import etags
+from hordeling import metrics
+from hordeling import r2
+from hordeling import exceptions as e
+from hordeling.steps import call, run
+from hordeling.ttl_cache import TTLCache
+from hordeling.consts import (
+    RESPONSE_CACHE_FRESH_SECONDS, RESPONSE_CACHE_RETENTION_SECONDS, RESPONSE_CACHE_SIZE,
+    RESPONSE_REFRESH_WORKERS, RESPONSE_REFRESH_LEASE_SECONDS, R2_URL_MIN_REMAINING_SECONDS,
+)
+
+# The process-local tier in front of redis
+local_responses = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_RETENTION_SECONDS)
+refresh_executor = ThreadPoolExecutor(max_workers=RESPONSE_REFRESH_WORKERS, thread_name_prefix="response_refresh")
+# The models this node is refreshing right now
+refreshing = set()
+refreshing_lock = Lock()
+
+
+def get_file_key(civitai_model):
+    """Identifies the file the response of this model was made from
+    A new version on CivitAI gets a new file id, or a new download url for safetensors
+    """
+    return f"{civitai_model.pickletensor_id}:{civitai_model.safetensor_url}"
+
+
+def get_current_file_key(model_id):
+    """Returns the file key of the latest metadata we have of this model, without asking CivitAI"""
+    return run(get_current_file_key_steps(model_id))
+
+
+def get_current_file_key_steps(model_id):
+    # Imported here, as civitai.py is where every resolve starts
+    from hordeling.civitai import CivitAIModel
+    entry = yield from civitai_cache.get_metadata_entry_steps(model_id)
+    if entry is None:
+        return None
+    return get_file_key(CivitAIModel(model_id, model_metadata=entry["metadata"]))
+
+
+def get_response_entry(model_id):
+    return run(get_response_entry_steps(model_id))
+
+
+def get_response_entry_steps(model_id):
+    entry = local_responses.get(str(model_id))
+    metrics.record_cache("response_local", entry is not None)
+    if entry is not None:
+        return entry
+    entry = yield call(hordeling_redis.hordeling_r_get_json, f"embedding_response:{model_id}")
+    metrics.record_cache("response_redis", entry is not None)
+    if entry is not None:
+        local_responses.set(str(model_id), entry)
+    return entry
+
+
+def store_response(model_id, civitai_model, result, etag, url_expires=None):
+    """Remembers the download details we resolved for this model
+    The safetensor filename is kept for our own R2 urls, so that they can be signed again once they expire
+    """
+    entry = {
+        "result": result,
+        "etag": etag,
+        "file_key": get_file_key(civitai_model),
+        "file_id": civitai_model.pickletensor_id,
+        "filename": civitai_model.get_safetensor_key() if url_expires is not None else None,
+        "url_expires": url_expires,
+        "fetched": time.time(),
+    }
+    local_responses.set(str(model_id), entry)
+    hordeling_redis.hordeling_r_setex_json(
+        f"embedding_response:{model_id}",
+        timedelta(seconds=RESPONSE_CACHE_RETENTION_SECONDS),
+        entry,
+    )
+    return entry
+
+
+def forget_response(model_id):
+    local_responses.delete(str(model_id))
+    hordeling_redis.hordeling_r_delete(f"embedding_response:{model_id}")
+
+
+def is_fresh(entry):
+    return time.time() - entry["fetched"] < RESPONSE_CACHE_FRESH_SECONDS
+
+
+def resign_url(model_id, entry):
+    """Our presigned url is about to expire, so we sign a new one and keep the rest of the entry"""
+    download = r2.get_safetensor_download_url_entry(entry["filename"])
+    sha256 = entry["result"].get("sha256")
+    etag = etags.store_embedding_etag(model_id, entry["file_id"], sha256, download["expires"])
+    entry = {
+        **entry,
+        "result": {**entry["result"], "url": download["url"]},
+        "etag": etag,
+        "url_expires": download["expires"],
+    }
+    local_responses.set(str(model_id), entry)
+    hordeling_redis.hordeling_r_setex_json(
+        f"embedding_response:{model_id}",
+        timedelta(seconds=RESPONSE_CACHE_RETENTION_SECONDS),
+        entry,
+    )
+    return entry
+
+
+def get_cached_response(model_id, refresh):
+    """Returns the cached response of this model in the same form as resolve_embedding(), or None if we have to resolve it
+    Stale entries are still returned, while refresh() runs once in the background to refresh them.
+    It should resolve the model without starting a conversion, and raise e.NotFound when the safetensor is missing
+    """
+    return run(get_cached_response_steps(model_id, refresh))
+
+
+def get_cached_response_steps(model_id, refresh):
+    entry = yield from get_response_entry_steps(model_id)
+    if entry is None:
+        return None
+    # A new version of the model was seen since we stored this
+    if entry["file_key"] != (yield from get_current_file_key_steps(model_id)):
+        metrics.record_cache("response_file", False)
+        yield call(forget_response, model_id)
+        return None
+    if entry["url_expires"] is not None and entry["url_expires"] - time.time() < R2_URL_MIN_REMAINING_SECONDS:
+        entry = yield call(resign_url, model_id, entry)
+    fresh = is_fresh(entry)
+    metrics.record_cache("response_fresh", fresh)
+    if not fresh:
+        yield call(schedule_refresh, model_id, refresh)
+    return dict(entry["result"]), 200, {"ETag": quote_etag(entry["etag"])}
+
+
+def schedule_refresh(model_id, refresh):
+    with refreshing_lock:
+        if model_id in refreshing:
+            return
+        refreshing.add(model_id)
+    # Only one node refreshes the same model at a time
+    lease_key = f"response_refresh:{model_id}"
+    token = hordeling_redis.hordeling_r_acquire_lease(lease_key, RESPONSE_REFRESH_LEASE_SECONDS)
+    if token is None:
+        with refreshing_lock:
+            refreshing.discard(model_id)
+        return
+    refresh_executor.submit(refresh_response, model_id, refresh, lease_key, token)
+
+
+def refresh_response(model_id, refresh, lease_key, token):
+    """Runs in the background. A successful refresh() stores the new entry on its own"""
+    try:
+        refresh()
+    except (e.BadRequest, e.NotFound):
+        # The model can't be served anymore, or its safetensor has to be converted again,
+        # so the stale entry points to nothing
+        forget_response(model_id)
+    except Exception as err:
+        logger.warning(f"Keeping the stale response of {model_id}, as refreshing it failed: {err}")
+    finally:
+        hordeling_redis.hordeling_r_release_lease(lease_key, token)
+        with refreshing_lock:
+            refreshing.discard(model_id)
@@ -1,8 +1,9 @@
-from flask import render_template, redirect, url_for, request
+from flask import render_template, redirect, url_for, request, Response
 from markdown import markdown
 from loguru import logger
 from hordeling.flask import APP
 import hordeling.exceptions as e
+from hordeling import metrics
 
 @logger.catch(reraise=True)
 @APP.route('/')
@@ -31,3 +32,8 @@ def index():
     </head>
     """
     return(head + markdown(findex))
+
+
+@APP.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
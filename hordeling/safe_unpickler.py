@@ -0,0 +1,280 @@
+"""Reads pytorch checkpoints without torch, using an unpickler which only allows a whitelist of globals
+
+Tensors are returned as read-only numpy arrays, mapped straight from the checkpoint file without copying.
+Both the zip container of torch>=1.6 and the older legacy container are supported.
+"""
+import io
+import mmap
+import pickle
+import struct
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+LEGACY_MAGIC_NUMBER = 0x1950a86a20f9469cfc6c
+ZIP_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+ZIP_LOCAL_HEADER_SIGNATURE = 0x04034b50
+
+STORAGE_DTYPES = {
+    "DoubleStorage": np.float64,
+    "FloatStorage": np.float32,
+    "HalfStorage": np.float16,
+    "LongStorage": np.int64,
+    "IntStorage": np.int32,
+    "ShortStorage": np.int16,
+    "CharStorage": np.int8,
+    "ByteStorage": np.uint8,
+    "BoolStorage": np.bool_,
+}
+
+
+class UnsupportedCheckpoint(NotImplementedError):
+    """The checkpoint is valid, but uses a container or dtype we cannot read without torch"""
+
+
+class ForbiddenGlobal(NotImplementedError):
+    """The pickle refers to something outside our whitelist"""
+
+
+class StorageType:
+    def __init__(self, name):
+        self.name = name
+        self.dtype = np.dtype(STORAGE_DTYPES[name]).newbyteorder("<")
+
+
+class PendingStorage:
+    """Stands in for storages whose data we have not located yet"""
+
+
+class ModuleStub:
+    """Stands in for torch modules such as ParameterDict. Only their state is kept"""
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def get(self, key, default=None):
+        return self.__dict__.get("_parameters", {}).get(key, default)
+
+    def __contains__(self, key):
+        return key in self.__dict__.get("_parameters", {})
+
+
+def rebuild_tensor(storage, storage_offset, size, stride, requires_grad=False, backward_hooks=None, metadata=None):
+    if isinstance(storage, PendingStorage):
+        return storage
+    size = tuple(size)
+    stride = tuple(stride)
+    if storage_offset < 0 or any(dim < 0 for dim in size) or any(step < 0 for step in stride):
+        raise ForbiddenGlobal("Tensors with negative offsets, sizes or strides are not allowed")
+    # We make sure the tensor fits in its storage, as as_strided would happily read outside of it
+    if 0 not in size:
+        last_element = storage_offset + sum((dim - 1) * step for dim, step in zip(size, stride))
+        if last_element >= len(storage):
+            raise ForbiddenGlobal("Tensor is larger than its storage")
+    if not size:
+        return storage[storage_offset:storage_offset + 1].reshape(())
+    return np.lib.stride_tricks.as_strided(
+        storage[storage_offset:],
+        shape=size,
+        strides=tuple(step * storage.itemsize for step in stride),
+        writeable=False,
+    )
+
+
+def rebuild_parameter(data, requires_grad, backward_hooks, state=None):
+    return data
+
+
+def rebuild_from_type(func, new_type, args, state):
+    return func(*args)
+
+
+SAFE_GLOBALS = {
+    ("torch._utils", "_rebuild_tensor_v2"): rebuild_tensor,
+    ("torch._utils", "_rebuild_parameter"): rebuild_parameter,
+    ("torch._utils", "_rebuild_parameter_with_state"): rebuild_parameter,
+    ("torch._tensor", "_rebuild_from_type_v2"): rebuild_from_type,
+    ("torch", "Tensor"): ModuleStub,
+    ("torch.nn.parameter", "Parameter"): ModuleStub,
+    ("torch.nn.modules.container", "ParameterDict"): ModuleStub,
+    ("collections", "OrderedDict"): OrderedDict,
+    ("builtins", "set"): set,
+    ("builtins", "frozenset"): frozenset,
+}
+
+
+class RestrictedUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, load_storage=None):
+        super().__init__(file, encoding="utf-8")
+        self.load_storage = load_storage
+
+    def find_class(self, module, name):
+        # Protocol 2 pickles use the python 2 name of builtins
+        if module == "__builtin__":
+            module = "builtins"
+        if (module, name) in SAFE_GLOBALS:
+            return SAFE_GLOBALS[(module, name)]
+        if module == "torch" and name.endswith("Storage"):
+            if name not in STORAGE_DTYPES:
+                raise UnsupportedCheckpoint(f"Storage type {name} cannot be read without torch")
+            return StorageType(name)
+        raise ForbiddenGlobal(f"'{module}.{name}' is not allowed in an embedding")
+
+    def persistent_load(self, saved_id):
+        if not isinstance(saved_id, tuple) or not saved_id:
+            raise ForbiddenGlobal("Unexpected persistent id")
+        # The legacy container refers to module classes along with their source code, which we ignore
+        if saved_id[0] == "module" and len(saved_id) > 1 and saved_id[1] is ModuleStub:
+            return ModuleStub
+        if saved_id[0] != "storage" or self.load_storage is None:
+            raise ForbiddenGlobal(f"Unexpected persistent id of type {saved_id[0]!r}")
+        return self.load_storage(saved_id)
+
+
+def unpack_storage_id(saved_id, length):
+    """Returns the first length fields of the persistent id of a storage
+    Raises ForbiddenGlobal when they are not what torch writes, as the pickle is untrusted
+    """
+    if len(saved_id) < length:
+        raise ForbiddenGlobal(f"Persistent id of a storage with {len(saved_id)} fields instead of {length}")
+    storage_type, key = saved_id[1:3]
+    if not isinstance(storage_type, StorageType):
+        raise ForbiddenGlobal(f"Unexpected storage type {storage_type!r}")
+    if not isinstance(key, str):
+        raise ForbiddenGlobal(f"Unexpected storage key {key!r}")
+    return saved_id[:length]
+
+
+def load(filename):
+    """Loads a pytorch checkpoint, returning numpy arrays in place of tensors
+
+    The returned arrays keep the file mapped in memory for as long as they exist
+    """
+    with open(filename, "rb") as checkpoint_file:
+        try:
+            mapped = mmap.mmap(checkpoint_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise UnsupportedCheckpoint(f"{filename} is empty")
+        return load_from(checkpoint_file, mapped)
+
+
+def loads(data):
+    """Same as load(), but for a checkpoint which is already in memory
+    The returned arrays are views of data, so it must not be modified while they exist
+    """
+    if not data:
+        raise UnsupportedCheckpoint("The checkpoint is empty")
+    return load_from(io.BytesIO(data), data)
+
+
+def load_from(checkpoint_file, mapped):
+    """Loads the checkpoint from the file object, reading the tensors straight out of mapped,
+    which is a buffer with the same contents
+    """
+    if zipfile.is_zipfile(checkpoint_file):
+        return load_zip(checkpoint_file, mapped)
+    checkpoint_file.seek(0)
+    return load_legacy(checkpoint_file, mapped)
+
+
+def map_zip_member(mapped, zip_file, info, dtype):
+    # Torch stores its tensors uncompressed, so we can map them straight from the file
+    if info.compress_type != zipfile.ZIP_STORED:
+        return np.frombuffer(zip_file.read(info), dtype=dtype)
+    if info.header_offset + ZIP_LOCAL_HEADER.size > len(mapped):
+        raise ForbiddenGlobal(f"Zip entry {info.filename} extends past the end of the file")
+    header = ZIP_LOCAL_HEADER.unpack_from(mapped, info.header_offset)
+    if header[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise ForbiddenGlobal(f"Corrupt zip entry {info.filename}")
+    data_offset = info.header_offset + ZIP_LOCAL_HEADER.size + header[9] + header[10]
+    if data_offset + info.file_size > len(mapped):
+        raise ForbiddenGlobal(f"Zip entry {info.filename} extends past the end of the file")
+    return np.frombuffer(mapped, dtype=dtype, count=info.file_size // dtype.itemsize, offset=data_offset)
+
+
+def load_zip(checkpoint_file, mapped):
+    with zipfile.ZipFile(checkpoint_file) as zip_file:
+        names = zip_file.namelist()
+        pickle_names = [name for name in names if name == "data.pkl" or name.endswith("/data.pkl")]
+        if len(pickle_names) != 1:
+            raise UnsupportedCheckpoint("The zip container does not hold a single data.pkl")
+        prefix = pickle_names[0][:-len("data.pkl")]
+        big_endian = False
+        if f"{prefix}byteorder" in names:
+            big_endian = zip_file.read(f"{prefix}byteorder").decode().strip() == "big"
+        storages = {}
+
+        def load_storage(saved_id):
+            _, storage_type, key, location, numel = unpack_storage_id(saved_id, 5)
+            if key not in storages:
+                dtype = storage_type.dtype
+                if big_endian:
+                    dtype = dtype.newbyteorder(">")
+                try:
+                    info = zip_file.getinfo(f"{prefix}data/{key}")
+                except KeyError:
+                    raise ForbiddenGlobal(f"Storage {key} is missing from the zip container")
+                storage = map_zip_member(mapped, zip_file, info, dtype)
+                if big_endian:
+                    storage = storage.astype(storage_type.dtype)
+                storages[key] = storage
+            return storages[key]
+
+        with zip_file.open(pickle_names[0]) as pickle_file:
+            return RestrictedUnpickler(pickle_file, load_storage).load()
+
+
+def load_legacy(checkpoint_file, mapped):
+    try:
+        magic_number = RestrictedUnpickler(checkpoint_file).load()
+    except (pickle.UnpicklingError, EOFError, ValueError) as err:
+        raise UnsupportedCheckpoint(f"Unknown checkpoint container: {err}")
+    if magic_number != LEGACY_MAGIC_NUMBER:
+        raise UnsupportedCheckpoint("Unknown checkpoint container")
+    RestrictedUnpickler(checkpoint_file).load()  # protocol version
+    sys_info = RestrictedUnpickler(checkpoint_file).load()
+    byteorder = "<" if sys_info.get("little_endian", True) else ">"
+    main_pickle_start = checkpoint_file.tell()
+    # The raw storages come after the main pickle, so we need a first pass to find out their types
+    storage_types = {}
+
+    def record_storage(saved_id):
+        _, storage_type, key = unpack_storage_id(saved_id, 3)
+        storage_types[key] = storage_type
+        return PendingStorage()
+
+    RestrictedUnpickler(checkpoint_file, record_storage).load()
+    storage_keys = RestrictedUnpickler(checkpoint_file).load()
+    storages = {}
+    for key in storage_keys:
+        if key not in storage_types:
+            raise ForbiddenGlobal(f"Storage {key} is not used by any tensor")
+        dtype = storage_types[key].dtype.newbyteorder(byteorder)
+        numel = struct.unpack(f"{byteorder}q", checkpoint_file.read(8))[0]
+        data_offset = checkpoint_file.tell()
+        if numel < 0 or data_offset + numel * dtype.itemsize > len(mapped):
+            raise ForbiddenGlobal(f"Storage {key} extends past the end of the file")
+        storage = np.frombuffer(mapped, dtype=dtype, count=numel, offset=data_offset)
+        if byteorder == ">":
+            storage = storage.astype(storage_types[key].dtype)
+        storages[key] = storage
+        checkpoint_file.seek(numel * dtype.itemsize, 1)
+
+    def load_storage(saved_id):
+        _, storage_type, root_key, location, numel, view_metadata = unpack_storage_id(saved_id, 6)
+        if root_key not in storages:
+            raise ForbiddenGlobal(f"Storage {root_key} is not in the checkpoint")
+        storage = storages[root_key]
+        if view_metadata is not None:
+            if not isinstance(view_metadata, tuple) or len(view_metadata) != 3:
+                raise ForbiddenGlobal(f"Unexpected view of storage {root_key}")
+            view_key, offset, view_size = view_metadata
+            if not isinstance(offset, int) or not isinstance(view_size, int) or offset < 0 or view_size < 0:
+                raise ForbiddenGlobal(f"Unexpected view of storage {root_key}")
+            storage = storage[offset:offset + view_size]
+        return storage
+
+    checkpoint_file.seek(main_pickle_start)
+    return RestrictedUnpickler(checkpoint_file, load_storage).load()
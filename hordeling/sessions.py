@@ -0,0 +1,33 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from hordeling.consts import WSGI_THREADS, HTTP_RETRIES
+
+
+def create_session():
+    """Creates a requests session which keeps its connections alive between requests
+    Sessions can be shared between threads as long as they're not modified after creation
+    """
+    retries = Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET", "HEAD"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=WSGI_THREADS,
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Used for the CivitAI API as well as the pickletensor downloads from the CivitAI CDN
+civitai_session = create_session()
+# Used to download the safetensors we have already uploaded
+r2_session = create_session()
@@ -0,0 +1,33 @@
+"""Lookups which are shared by the blocking and the async serving modes
+
+Each lookup is written once, as a generator which yields a call() for every bit of I/O it needs.
+run() makes those calls with our blocking clients. async_clients.run_async() makes them with
+non-blocking clients where it has one, and hands everything else to a thread.
+"""
+from collections import namedtuple
+
+Call = namedtuple("Call", ["function", "args"])
+
+
+def call(function, *args):
+    return Call(function, args)
+
+
+def run(steps):
+    """Runs the steps of a lookup with our blocking clients and returns its result"""
+    result = None
+    error = None
+    while True:
+        try:
+            if error is not None:
+                next_call = steps.throw(error)
+            else:
+                next_call = steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            result = next_call.function(*next_call.args)
+            error = None
+        except Exception as err:
+            result = None
+            error = err
@@ -0,0 +1,64 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class TTLCache:
+    """A thread-safe, in-process LRU cache whose entries also expire after a while
+
+    If maxbytes is set, the cache is also limited by the total size of its values, as measured by sizeof
+    """
+
+    def __init__(self, maxsize, ttl, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            value, expires, size = entry
+            if expires <= time.monotonic():
+                self.pop_entry(key)
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        with self.lock:
+            self.pop_entry(key)
+            # A value which could never fit would just flush everything else
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self.entries[key] = (value, time.monotonic() + ttl, size)
+            self.bytes += size
+            while len(self.entries) > self.maxsize or (self.maxbytes is not None and self.bytes > self.maxbytes):
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def pop_entry(self, key):
+        """Removes the entry while the lock is already held"""
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def delete(self, key):
+        with self.lock:
+            self.pop_entry(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
@@ -6,6 +6,7 @@ load_dotenv()
 
 from hordeling.argparser import args
 from hordeling.flask import APP
+from hordeling.consts import WSGI_THREADS
 from loguru import logger
 
 if __name__ == "__main__":
@@ -22,5 +23,5 @@ if __name__ == "__main__":
     if args.insecure:
         allowed_host = "0.0.0.0"
         logger.init_warn("WSGI Mode", status="Insecure")
-    serve(APP, port=args.port, url_scheme=url_scheme, threads=45, connection_limit=1024, asyncore_use_poll=True)
+    serve(APP, port=args.port, url_scheme=url_scheme, threads=WSGI_THREADS, connection_limit=1024, asyncore_use_poll=True)
     logger.init("WSGI Server", status="Stopped")
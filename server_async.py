@@ -0,0 +1,21 @@
+from dotenv import load_dotenv
+import os
+import logging
+
+load_dotenv()
+
+from hordeling.argparser import args
+from loguru import logger
+
+if __name__ == "__main__":
+    # Only setting this for the ASGI logs
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(module)s:%(lineno)d - %(message)s', level=logging.ERROR)
+    import uvicorn
+    from hordeling.asgi import app
+
+    logger.init("ASGI Server", status="Starting")
+    if args.insecure:
+        os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'  # Disable this on prod
+        logger.init_warn("ASGI Mode", status="Insecure")
+    uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="error", limit_concurrency=4096)
+    logger.init("ASGI Server", status="Stopped")
@@ -0,0 +1,78 @@
+import hashlib
+import itertools
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR))
+
+from tests.fakes import FakeCivitAI, FakeS3, build_pickletensor
+
+# Every test gets models nobody used before, as the hordeling caches what it learns about each one
+model_ids = itertools.count(1)
+
+
+# The hordeling reads its configuration and opens its log when it's first imported, which happens
+# while the test modules are collected. So the stand-ins need to be running before then
+civitai = None
+s3 = None
+environment = pytest.MonkeyPatch()
+working_dir = tempfile.TemporaryDirectory()
+
+
+def pytest_configure(config):
+    global civitai, s3
+    civitai = FakeCivitAI([]).start()
+    s3 = FakeS3().start()
+    environment.setenv("CIVITAI_API_URL", civitai.api_url)
+    environment.setenv("R2_SAFETENSORS_ACCOUNT", s3.url)
+    environment.setenv("AWS_ACCESS_KEY_ID", "test")
+    environment.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    environment.setenv("AWS_DEFAULT_REGION", "auto")
+    # Our S3 stand-in doesn't understand streamed checksums
+    environment.setenv("AWS_REQUEST_CHECKSUM_CALCULATION", "when_required")
+    # Nothing listens on port 6379 of this address, so every redis check fails fast
+    environment.setenv("REDIS_IP", "127.0.0.2")
+    environment.setenv("REDIS_CONNECT_TIMEOUT", "0.1")
+    # The hordeling writes its log and the downloaded models to the working directory
+    environment.chdir(working_dir.name)
+
+
+def pytest_unconfigure(config):
+    environment.undo()
+    working_dir.cleanup()
+    if civitai is not None:
+        civitai.stop()
+        s3.stop()
+
+
+@pytest.fixture
+def fakes():
+    """The local stand-ins of CivitAI and R2, which the hordeling is pointed at"""
+    return civitai, s3
+
+
+@pytest.fixture
+def serve_models(fakes):
+    """Replaces the models CivitAI serves with the given number of new ones, and returns their ids"""
+    civitai, _ = fakes
+
+    def serve(count):
+        new_ids = [next(model_ids) for _ in range(count)]
+        with civitai.lock:
+            civitai.models = {model_id: build_pickletensor(8) for model_id in new_ids}
+            civitai.hashes = {
+                model_id: hashlib.sha256(pickletensor).hexdigest().upper()
+                for model_id, pickletensor in civitai.models.items()
+            }
+        return [str(model_id) for model_id in new_ids]
+    return serve
+
+
+@pytest.fixture
+def unused_model_id():
+    """The id of a model CivitAI doesn't know"""
+    return str(next(model_ids))
@@ -0,0 +1,238 @@
+"""Local stand-ins for the services the hordeling depends on, for the tests, benchmarks and offline runs
+
+FakeCivitAI serves model metadata, listings and pickletensor downloads.
+FakeS3 is just enough of an S3-compatible API for what r2.py does with it.
+Both run on a background thread and can add latency to every response.
+"""
+import hashlib
+import io
+import re
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, code, body=b"", content_type="application/json", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+
+class BacklogHTTPServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections when many clients connect at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeServer:
+    handler_class = None
+
+    def __init__(self, latency=0.0, port=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        handler = type("Handler", (self.handler_class,), {"fake": self})
+        self.server = BacklogHTTPServer(("127.0.0.1", port), handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def build_pickletensor(vectors):
+    """Builds an embedding like the ones from the stable diffusion webui, using torch"""
+    import torch
+    embedding = {
+        "string_to_token": {"*": torch.tensor(265)},
+        "string_to_param": torch.nn.ParameterDict({"*": torch.nn.Parameter(torch.randn(vectors, 768))}),
+        "name": "benchmark",
+        "step": 1000,
+    }
+    buffer = io.BytesIO()
+    torch.save(embedding, buffer)
+    return buffer.getvalue()
+
+
+class CivitAIHandler(QuietHandler):
+
+    def do_GET(self):
+        self.fake.wait()
+        parsed = urlparse(self.path)
+        match = re.fullmatch(r"/api/v1/models/(\d+)", parsed.path)
+        if match:
+            return self.send_model(int(match.group(1)))
+        if parsed.path == "/api/v1/models":
+            return self.send_listing(parse_qs(parsed.query))
+        match = re.fullmatch(r"/download/(\d+)", parsed.path)
+        if match:
+            return self.send_download(int(match.group(1)))
+        self.send_body(404, b'{"error": "Not found"}')
+
+    def send_model(self, model_id):
+        with self.fake.lock:
+            self.fake.metadata_requests += 1
+        if model_id not in self.fake.models:
+            return self.send_body(404, b'{"error": "No model with id"}')
+        metadata = self.fake.get_metadata(model_id)
+        etag = f'"{model_id}-{metadata["modelVersions"][0]["files"][0]["id"]}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self.send_body(304)
+        import json
+        self.send_body(200, json.dumps(metadata).encode(), headers={"ETag": etag, "Last-Modified": formatdate(usegmt=True)})
+
+    def send_listing(self, query):
+        import json
+        limit = int(query.get("limit", ["100"])[0])
+        cursor = int(query.get("cursor", ["0"])[0])
+        model_ids = sorted(self.fake.models)[cursor:cursor + limit]
+        next_cursor = cursor + limit if cursor + limit < len(self.fake.models) else None
+        page = {
+            "items": [self.fake.get_metadata(model_id) for model_id in model_ids],
+            "metadata": {"nextCursor": next_cursor},
+        }
+        self.send_body(200, json.dumps(page).encode())
+
+    def send_download(self, model_id):
+        with self.fake.lock:
+            self.fake.downloads[model_id] = self.fake.downloads.get(model_id, 0) + 1
+        if model_id not in self.fake.models:
+            return self.send_body(404)
+        self.send_body(200, self.fake.models[model_id], content_type="application/octet-stream")
+
+
+class FakeCivitAI(FakeServer):
+    """Serves Textual Inversions with the given ids, each with its own pickletensor
+    With shared_pickletensor, they all use the same one, as if it was re-uploaded under every model
+    """
+    handler_class = CivitAIHandler
+
+    def __init__(self, model_ids, vectors=8, latency=0.0, port=0, shared_pickletensor=False):
+        super().__init__(latency, port)
+        if shared_pickletensor:
+            pickletensor = build_pickletensor(vectors)
+            self.models = {model_id: pickletensor for model_id in model_ids}
+        else:
+            self.models = {model_id: build_pickletensor(vectors) for model_id in model_ids}
+        self.hashes = {model_id: hashlib.sha256(pickletensor).hexdigest().upper() for model_id, pickletensor in self.models.items()}
+        self.metadata_requests = 0
+        self.downloads = {}
+
+    @property
+    def api_url(self):
+        return f"{self.url}/api/v1"
+
+    def get_safetensor_key(self, model_id):
+        """The key in R2 under which the hordeling stores the converted model"""
+        return f"benchmark_{model_id}_{int(model_id) * 10}.safetensors"
+
+    def get_metadata(self, model_id):
+        return {
+            "id": model_id,
+            "name": f"Benchmark Embedding {model_id}",
+            "type": "TextualInversion",
+            "modelVersions": [{
+                "files": [{
+                    "id": model_id * 10,
+                    "name": f"benchmark_{model_id}.pt",
+                    "sizeKB": len(self.models[model_id]) / 1024,
+                    "pickleScanResult": "Success",
+                    "metadata": {"format": "PickleTensor"},
+                    "hashes": {"SHA256": self.hashes[model_id]},
+                    "downloadUrl": f"{self.url}/download/{model_id}",
+                }],
+            }],
+        }
+
+
+class S3Handler(QuietHandler):
+
+    def get_key(self):
+        # Path-style addressing: /<bucket>/<key>
+        path = unquote(urlparse(self.path).path)
+        return path.lstrip("/").partition("/")[2]
+
+    def do_HEAD(self):
+        self.fake.wait()
+        with self.fake.lock:
+            self.fake.requests["head"] += 1
+            stored = self.fake.objects.get(self.get_key())
+        if stored is None:
+            return self.send_body(404, content_type="application/xml")
+        self.send_object_headers(stored)
+
+    def do_GET(self):
+        self.fake.wait()
+        with self.fake.lock:
+            self.fake.requests["get"] += 1
+            stored = self.fake.objects.get(self.get_key())
+        if stored is None:
+            return self.send_body(404, b"<Error><Code>NoSuchKey</Code></Error>", content_type="application/xml")
+        self.send_object_headers(stored)
+
+    def send_object_headers(self, stored):
+        body, metadata = stored
+        headers = {"ETag": f'"{hashlib.md5(body).hexdigest()}"'}
+        for name, value in metadata.items():
+            headers[f"x-amz-meta-{name}"] = value
+        self.send_body(200, body, content_type="application/octet-stream", headers=headers)
+
+    def do_PUT(self):
+        self.fake.wait()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        metadata = {
+            header[len("x-amz-meta-"):]: value
+            for header, value in self.headers.items()
+            if header.lower().startswith("x-amz-meta-")
+        }
+        if self.fake.deny_puts:
+            error = "<Error><Code>AccessDenied</Code><Message>Access Denied</Message></Error>"
+            return self.send_body(403, error.encode(), content_type="application/xml")
+        copy_source = self.headers.get("x-amz-copy-source")
+        with self.fake.lock:
+            self.fake.requests["put"] += 1
+            if copy_source is not None:
+                source_key = unquote(copy_source).lstrip("/").partition("/")[2]
+                body = self.fake.objects[source_key][0]
+            self.fake.objects[self.get_key()] = (body, metadata)
+        if copy_source is not None:
+            result = f"<CopyObjectResult><ETag>\"{hashlib.md5(body).hexdigest()}\"</ETag></CopyObjectResult>"
+            return self.send_body(200, result.encode(), content_type="application/xml")
+        self.send_body(200, headers={"ETag": f'"{hashlib.md5(body).hexdigest()}"'})
+
+
+class FakeS3(FakeServer):
+    """Keeps uploaded objects in memory. Signatures are not checked
+    With deny_puts, every upload is refused like R2 does for a key without write access
+    """
+    handler_class = S3Handler
+
+    def __init__(self, latency=0.0, port=0):
+        super().__init__(latency, port)
+        self.objects = {}
+        self.deny_puts = False
+        self.requests = {"head": 0, "get": 0, "put": 0}
@@ -0,0 +1,98 @@
+"""Sends requests to the Flask APP, against the local stand-ins of CivitAI and R2 from tests/fakes.py"""
+import json
+
+import pytest
+
+
+@pytest.fixture
+def client(fakes):
+    from hordeling import APP
+    return APP.test_client()
+
+
+@pytest.fixture
+def full_node(monkeypatch):
+    from hordeling import jobs
+    monkeypatch.setattr(jobs, "can_admit", lambda cost: False)
+
+
+def test_busy_node_sends_its_retry_after(client, serve_models, full_node):
+    from hordeling.consts import CONVERSION_RETRY_AFTER_SECONDS
+    model_id, = serve_models(1)
+    response = client.get(f"/api/v1/embedding/{model_id}")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(CONVERSION_RETRY_AFTER_SECONDS)
+
+
+def test_accepted_conversion_has_no_retry_after(client, serve_models):
+    model_id, = serve_models(1)
+    response = client.get(f"/api/v1/embedding/{model_id}")
+    assert response.status_code == 202
+    assert "Retry-After" not in response.headers
+    assert "X-RateLimit-Remaining" in response.headers
+
+
+@pytest.fixture
+def converted_model(fakes, serve_models):
+    """A model whose safetensor is already in R2"""
+    civitai, s3 = fakes
+    model_id, = serve_models(1)
+    with s3.lock:
+        s3.objects[civitai.get_safetensor_key(model_id)] = (b"converted", {"sha256": "0" * 64})
+    return model_id
+
+
+def stop_resolving(monkeypatch):
+    """Fails every request which isn't served from the response cache"""
+    from hordeling import resolve
+
+    def retrieve_model_metadata_steps(model_id):
+        raise AssertionError(f"{model_id} was resolved instead of served from the cache")
+        yield
+    monkeypatch.setattr(resolve, "retrieve_model_metadata_steps", retrieve_model_metadata_steps)
+
+
+def test_embedding_is_served_from_cache(client, converted_model, monkeypatch):
+    response = client.get(f"/api/v1/embedding/{converted_model}")
+    assert response.status_code == 200
+    with monkeypatch.context() as patch:
+        stop_resolving(patch)
+        cached = client.get(f"/api/v1/embedding/{converted_model}")
+    assert cached.status_code == 200
+    assert cached.json == response.json
+    assert cached.headers["ETag"] == response.headers["ETag"]
+
+
+def test_batch_is_served_from_cache(client, converted_model, monkeypatch):
+    response = client.post("/api/v1/embeddings", json={"model_ids": [converted_model]})
+    assert response.json["results"][0]["code"] == 200
+    with monkeypatch.context() as patch:
+        stop_resolving(patch)
+        cached = client.post("/api/v1/embeddings", json={"model_ids": [converted_model]})
+    assert cached.json == response.json
+
+
+def test_async_embedding_is_served_from_cache(fakes, converted_model, monkeypatch):
+    from starlette.testclient import TestClient
+    from hordeling.asgi import app
+    with TestClient(app) as async_client:
+        response = async_client.get(f"/api/v1/embedding/{converted_model}")
+        assert response.status_code == 200
+        with monkeypatch.context() as patch:
+            stop_resolving(patch)
+            cached = async_client.get(f"/api/v1/embedding/{converted_model}")
+    assert cached.status_code == 200
+    assert cached.json() == response.json()
+
+
+def test_index_of_missing_safetensor_is_ignored(client, fakes, converted_model):
+    civitai, s3 = fakes
+    # An identical pickletensor was indexed, but its safetensor never made it to R2
+    index_key = f"content_index/{civitai.hashes[int(converted_model)].lower()}.json"
+    with s3.lock:
+        s3.objects[index_key] = (json.dumps({"key": "missing.safetensors", "sha256": "0" * 64}).encode(), {})
+    response = client.get(f"/api/v1/embedding/{converted_model}")
+    assert response.status_code == 200
+    assert civitai.get_safetensor_key(converted_model) in response.json["url"]
+    # The index is fixed to point to our own safetensor
+    assert json.loads(s3.objects[index_key][0])["key"] == civitai.get_safetensor_key(converted_model)
@@ -0,0 +1,49 @@
+"""Checks that converted safetensors are verified against the tensors they came from"""
+import numpy as np
+import pytest
+from safetensors.numpy import save
+
+from hordeling.convert_to_safetensors import get_tensor_bytes, verify_safetensors_bytes, verify_safetensors_file
+
+
+@pytest.fixture
+def tensor():
+    return np.random.default_rng().standard_normal((8, 768), dtype=np.float32)
+
+
+@pytest.fixture
+def safetensor_bytes(tensor):
+    return save({"emb_params": tensor}, metadata={"format": "pt"})
+
+
+def test_verify_passes_correct_conversion(tensor, safetensor_bytes, tmp_path):
+    tensor_bytes = {"emb_params": get_tensor_bytes(tensor, False)}
+    verify_safetensors_bytes(safetensor_bytes, tensor_bytes)
+    filename = tmp_path / "embedding.safetensors"
+    filename.write_bytes(safetensor_bytes)
+    verify_safetensors_file(filename, tensor_bytes)
+
+
+def test_verify_rejects_mismatched_tensor(tensor, safetensor_bytes, tmp_path):
+    changed = tensor.copy()
+    changed[-1, -1] += 1
+    tensor_bytes = {"emb_params": get_tensor_bytes(changed, False)}
+    with pytest.raises(RuntimeError, match="do not match"):
+        verify_safetensors_bytes(safetensor_bytes, tensor_bytes)
+    filename = tmp_path / "embedding.safetensors"
+    filename.write_bytes(safetensor_bytes)
+    with pytest.raises(RuntimeError, match="do not match"):
+        verify_safetensors_file(filename, tensor_bytes)
+
+
+def test_verify_rejects_missing_tensor(tensor, safetensor_bytes):
+    with pytest.raises(RuntimeError, match="missing tensor"):
+        verify_safetensors_bytes(safetensor_bytes, {"other_params": get_tensor_bytes(tensor, False)})
+
+
+@pytest.mark.parametrize("length", [4, 16, -16], ids=["size", "header", "data"])
+def test_verify_rejects_truncated_file(tensor, safetensor_bytes, tmp_path, length):
+    filename = tmp_path / "embedding.safetensors"
+    filename.write_bytes(safetensor_bytes[:length])
+    with pytest.raises(RuntimeError):
+        verify_safetensors_file(filename, {"emb_params": get_tensor_bytes(tensor, False)})
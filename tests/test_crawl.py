@@ -0,0 +1,138 @@
+"""Runs crawl.py against the local stand-ins of CivitAI and R2 from tests/fakes.py"""
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+@pytest.fixture
+def crawl(fakes, monkeypatch):
+    import crawl
+    monkeypatch.setattr(crawl.crawl_args, "page_size", 100)
+    monkeypatch.setattr(crawl.crawl_args, "max_pages", None)
+    return crawl
+
+
+def run_crawl(crawl, checkpoint, ids=None, tmp_path=None):
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        if ids is None:
+            crawl.crawl_civitai(checkpoint, executor)
+        else:
+            ids_filename = tmp_path / "ids.txt"
+            ids_filename.write_text("\n".join(ids) + "\n")
+            crawl.crawl_ids_file(ids_filename, checkpoint, executor)
+
+
+def test_checkpoint_appends_and_reloads(crawl, tmp_path):
+    filename = tmp_path / "checkpoint.json"
+    checkpoint = crawl.Checkpoint(filename)
+    checkpoint.mark_done("1")
+    checkpoint.mark_failed("2", "Not a Textual Inversion")
+    checkpoint.next_page(100)
+    checkpoint.close()
+    # Every change is one more line, instead of a rewrite of the whole file
+    assert len(filename.read_text().splitlines()) == 4
+    # An interrupted write leaves a broken last line behind
+    with open(filename, "a") as checkpoint_file:
+        checkpoint_file.write('{"done": ["3"')
+    checkpoint = crawl.Checkpoint(filename)
+    checkpoint.close()
+    assert checkpoint.done == {"1"}
+    assert checkpoint.failed == {"2": "Not a Textual Inversion"}
+    assert (checkpoint.cursor, checkpoint.pages) == (100, 1)
+    # Loading compacts the file back to a single line
+    assert len(filename.read_text().splitlines()) == 1
+
+
+def test_checkpoint_loads_full_json(crawl, tmp_path):
+    filename = tmp_path / "checkpoint.json"
+    filename.write_text(json.dumps({"cursor": 5, "pages": 2, "done": ["1", "2"], "failed": {"3": "Gone"}}))
+    checkpoint = crawl.Checkpoint(filename)
+    checkpoint.close()
+    assert checkpoint.done == {"1", "2"}
+    assert checkpoint.failed == {"3": "Gone"}
+    assert (checkpoint.cursor, checkpoint.pages) == (5, 2)
+
+
+def test_crawl_resumes_from_checkpoint(crawl, fakes, serve_models, tmp_path):
+    civitai, s3 = fakes
+    ids = serve_models(4)
+    filename = tmp_path / "checkpoint.json"
+    crawl.crawl_args.page_size = 2
+    crawl.crawl_args.max_pages = 1
+    checkpoint = crawl.Checkpoint(filename)
+    run_crawl(crawl, checkpoint)
+    checkpoint.close()
+    assert checkpoint.done == set(ids[:2])
+    # An interrupted crawl continues on the page after the last one it finished
+    crawl.crawl_args.max_pages = None
+    checkpoint = crawl.Checkpoint(filename)
+    assert checkpoint.cursor == 2
+    run_crawl(crawl, checkpoint)
+    checkpoint.close()
+    assert checkpoint.done == set(ids)
+    assert all(civitai.downloads[int(model_id)] == 1 for model_id in ids)
+    assert all(civitai.get_safetensor_key(model_id) in s3.objects for model_id in ids)
+
+
+def test_crawl_skips_done_models(crawl, fakes, serve_models, tmp_path):
+    civitai, _ = fakes
+    ids = serve_models(2)
+    checkpoint = crawl.Checkpoint(tmp_path / "checkpoint.json")
+    checkpoint.mark_done(ids[0])
+    run_crawl(crawl, checkpoint, ids=ids, tmp_path=tmp_path)
+    checkpoint.close()
+    assert int(ids[0]) not in civitai.downloads
+    assert civitai.downloads[int(ids[1])] == 1
+
+
+def test_crawl_skips_converted_models(crawl, fakes, serve_models, tmp_path):
+    civitai, s3 = fakes
+    ids = serve_models(2)
+    with s3.lock:
+        s3.objects[civitai.get_safetensor_key(ids[0])] = (b"converted", {})
+    checkpoint = crawl.Checkpoint(tmp_path / "checkpoint.json")
+    run_crawl(crawl, checkpoint)
+    checkpoint.close()
+    assert checkpoint.done == set(ids)
+    assert int(ids[0]) not in civitai.downloads
+    assert civitai.downloads[int(ids[1])] == 1
+    assert s3.objects[civitai.get_safetensor_key(ids[0])][0] == b"converted"
+    # Safetensors from before the content index are added to it, so that identical pickletensors map to them
+    index_key = f"content_index/{civitai.hashes[int(ids[0])].lower()}.json"
+    assert json.loads(s3.objects[index_key][0])["key"] == civitai.get_safetensor_key(ids[0])
+
+
+def test_crawl_records_failed_models(crawl, fakes, serve_models, unused_model_id, tmp_path):
+    civitai, s3 = fakes
+    good_id, corrupted_id = serve_models(2)
+    missing_id = unused_model_id
+    # The pickletensor we download won't match the hash CivitAI tells us
+    civitai.hashes[int(corrupted_id)] = "0" * 64
+    checkpoint = crawl.Checkpoint(tmp_path / "checkpoint.json")
+    run_crawl(crawl, checkpoint, ids=[good_id, corrupted_id, missing_id], tmp_path=tmp_path)
+    checkpoint.close()
+    assert checkpoint.done == {good_id}
+    assert set(checkpoint.failed) == {corrupted_id, missing_id}
+    assert civitai.get_safetensor_key(corrupted_id) not in s3.objects
+
+
+def test_crawl_retries_temporary_failures(crawl, fakes, serve_models, tmp_path, monkeypatch):
+    civitai, s3 = fakes
+    ids = serve_models(1)
+    filename = tmp_path / "checkpoint.json"
+
+    def unavailable(self, progress=None):
+        raise crawl.e.ServiceUnavailable("R2 is down")
+    with monkeypatch.context() as patch:
+        patch.setattr(crawl.CivitAIModel, "convert_safetensor", unavailable)
+        checkpoint = crawl.Checkpoint(filename)
+        run_crawl(crawl, checkpoint, ids=ids, tmp_path=tmp_path)
+        checkpoint.close()
+    assert not checkpoint.is_done(ids[0])
+    # The next run tries it again
+    checkpoint = crawl.Checkpoint(filename)
+    run_crawl(crawl, checkpoint, ids=ids, tmp_path=tmp_path)
+    checkpoint.close()
+    assert checkpoint.done == set(ids)
+    assert civitai.get_safetensor_key(ids[0]) in s3.objects
@@ -0,0 +1,46 @@
+"""Runs conversion jobs against the local stand-ins of CivitAI and R2 from tests/fakes.py"""
+import time
+
+import pytest
+
+
+@pytest.fixture
+def deny_uploads(fakes):
+    _, s3 = fakes
+    s3.deny_puts = True
+    yield
+    s3.deny_puts = False
+
+
+def wait_for_job(jobs, job_id, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = jobs.get_job(job_id)
+        if job["status"] in jobs.FINISHED_STATUSES:
+            return job
+        time.sleep(0.1)
+    raise TimeoutError(f"Job {job_id} did not finish")
+
+
+def test_job_converts_model(fakes, serve_models):
+    from hordeling import jobs, r2
+    from hordeling.civitai import CivitAIModel
+    civitai, s3 = fakes
+    model_id, = serve_models(1)
+    job = wait_for_job(jobs, jobs.submit_conversion(CivitAIModel(model_id))["id"])
+    assert job["status"] == "done"
+    assert civitai.get_safetensor_key(model_id) in s3.objects
+    assert r2.check_safetensor(civitai.get_safetensor_key(model_id))
+
+
+def test_job_fails_when_upload_is_refused(fakes, serve_models, deny_uploads):
+    from hordeling import jobs, r2
+    from hordeling.civitai import CivitAIModel
+    civitai, s3 = fakes
+    model_id, = serve_models(1)
+    model = CivitAIModel(model_id)
+    job = wait_for_job(jobs, jobs.submit_conversion(model)["id"])
+    assert job["status"] == "failed"
+    # Nothing may remember the safetensor which never made it to R2
+    assert not r2.check_safetensor(civitai.get_safetensor_key(model_id))
+    assert f"content_index/{model.pickletensor_hash.lower()}.json" not in s3.objects
@@ -0,0 +1,190 @@
+"""Checks that the whitelist unpickler reads what torch writes, and nothing else"""
+import io
+import os
+import pickle
+import zipfile
+
+import numpy as np
+import pytest
+import torch
+
+from hordeling import safe_unpickler
+
+
+def save_embedding(tensor, **kwargs):
+    embedding = {
+        "string_to_token": {"*": torch.tensor(265)},
+        "string_to_param": torch.nn.ParameterDict({"*": torch.nn.Parameter(tensor)}),
+        "name": "test",
+        "step": 1000,
+    }
+    buffer = io.BytesIO()
+    torch.save(embedding, buffer, **kwargs)
+    return buffer.getvalue()
+
+
+def rewrite_zip(data, rewrite):
+    """Copies the zip container, passing every member through rewrite(name, contents)"""
+    output = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(data)) as source, zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as target:
+        for info in source.infolist():
+            target.writestr(info.filename, rewrite(info.filename, source.read(info)))
+    return output.getvalue()
+
+
+class Payload:
+    """Runs the function with the argument when it's unpickled"""
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def __reduce__(self):
+        return self.function, self.args
+
+
+FORBIDDEN_PAYLOADS = [
+    pytest.param(Payload(os.system, "true"), id="system"),
+    pytest.param(Payload(getattr, "", "join"), id="getattr"),
+]
+
+
+@pytest.fixture
+def tensor():
+    return torch.randn(8, 768)
+
+
+def test_loads_zip_checkpoint(tensor):
+    loaded = safe_unpickler.loads(save_embedding(tensor))
+    assert np.array_equal(loaded["string_to_param"].get("*"), tensor.numpy())
+    assert loaded["name"] == "test"
+
+
+def test_load_maps_file(tensor, tmp_path):
+    filename = tmp_path / "embedding.pt"
+    filename.write_bytes(save_embedding(tensor))
+    loaded = safe_unpickler.load(filename)
+    assert np.array_equal(loaded["string_to_param"].get("*"), tensor.numpy())
+
+
+def test_loads_legacy_checkpoint(tensor):
+    loaded = safe_unpickler.loads(save_embedding(tensor, _use_new_zipfile_serialization=False))
+    assert np.array_equal(loaded["string_to_param"].get("*"), tensor.numpy())
+
+
+def test_loads_big_endian_checkpoint(tensor):
+    buffer = io.BytesIO()
+    torch.save({"emb_params": tensor}, buffer)
+
+    def to_big_endian(name, contents):
+        if name.endswith("/byteorder"):
+            return b"big"
+        if name.endswith("/data/0"):
+            return np.frombuffer(contents, dtype="<f4").astype(">f4").tobytes()
+        return contents
+    loaded = safe_unpickler.loads(rewrite_zip(buffer.getvalue(), to_big_endian))
+    assert np.array_equal(loaded["emb_params"], tensor.numpy())
+
+
+def test_loads_strided_tensor(tensor):
+    loaded = safe_unpickler.loads(save_embedding(tensor.t()))
+    assert np.array_equal(loaded["string_to_param"].get("*"), tensor.t().numpy())
+
+
+@pytest.mark.parametrize("payload", FORBIDDEN_PAYLOADS)
+def test_rejects_forbidden_globals(payload):
+    with pytest.raises(safe_unpickler.ForbiddenGlobal):
+        safe_unpickler.loads(pickle.dumps(payload))
+
+
+@pytest.mark.parametrize("payload", FORBIDDEN_PAYLOADS)
+def test_rejects_forbidden_globals_in_zip(tensor, payload):
+    def replace_pickle(name, contents):
+        if name.endswith("/data.pkl"):
+            return pickle.dumps({"string_to_param": payload})
+        return contents
+    with pytest.raises(safe_unpickler.ForbiddenGlobal):
+        safe_unpickler.loads(rewrite_zip(save_embedding(tensor), replace_pickle))
+
+
+@pytest.mark.parametrize("payload", FORBIDDEN_PAYLOADS)
+def test_rejects_forbidden_globals_in_legacy(payload):
+    data = b"".join(pickle.dumps(part) for part in [
+        safe_unpickler.LEGACY_MAGIC_NUMBER,
+        1001,
+        {"little_endian": True},
+        payload,
+    ])
+    with pytest.raises(safe_unpickler.ForbiddenGlobal):
+        safe_unpickler.loads(data)
+
+
+@pytest.mark.parametrize("storage_offset, size, stride", [
+    pytest.param(10, (1,), (1,), id="offset"),
+    pytest.param(0, (11,), (1,), id="size"),
+    pytest.param(0, (2, 5), (6, 1), id="stride"),
+    pytest.param(-1, (1,), (1,), id="negative"),
+])
+def test_rebuild_tensor_stays_in_storage(storage_offset, size, stride):
+    storage = np.zeros(10, dtype=np.float32)
+    with pytest.raises(safe_unpickler.ForbiddenGlobal):
+        safe_unpickler.rebuild_tensor(storage, storage_offset, size, stride)
+
+
+def test_rebuild_tensor_fills_storage():
+    storage = np.arange(10, dtype=np.float32)
+    tensor = safe_unpickler.rebuild_tensor(storage, 0, (2, 5), (5, 1))
+    assert np.array_equal(tensor, storage.reshape(2, 5))
+    assert not tensor.flags.writeable
+
+
+def test_map_zip_member_stays_in_file(tensor):
+    data = save_embedding(tensor)
+    with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+        info = next(info for info in zip_file.infolist() if info.filename.endswith("/data/0"))
+        info.file_size = len(data)
+        with pytest.raises(safe_unpickler.ForbiddenGlobal):
+            safe_unpickler.map_zip_member(data, zip_file, info, np.dtype("<f4"))
+        info.header_offset = len(data)
+        with pytest.raises(safe_unpickler.ForbiddenGlobal):
+            safe_unpickler.map_zip_member(data, zip_file, info, np.dtype("<f4"))
+
+
+def build_legacy_checkpoint(saved_id):
+    """A legacy checkpoint whose only tensor uses a storage with the given persistent id"""
+    storage = object()
+
+    class StorageIdPickler(pickle.Pickler):
+        def persistent_id(self, obj):
+            if obj is storage:
+                return saved_id
+            return None
+
+    buffer = io.BytesIO()
+    for part in [safe_unpickler.LEGACY_MAGIC_NUMBER, 1001, {"little_endian": True}]:
+        pickle.dump(part, buffer)
+    StorageIdPickler(buffer).dump({"tensor": storage})
+    pickle.dump(["0"], buffer)
+    buffer.write(np.int64(1).tobytes() + np.float32(1).tobytes())
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize("saved_id", [
+    pytest.param(("storage",), id="short"),
+    pytest.param(("storage", torch.FloatStorage, "0", "cpu"), id="short_view"),
+    pytest.param(("storage", "FloatStorage", "0", "cpu", 1, None), id="type"),
+    pytest.param(("storage", torch.FloatStorage, ["0"], "cpu", 1, None), id="key"),
+    pytest.param(("storage", torch.FloatStorage, "0", "cpu", 1, ("0", 0)), id="view"),
+    pytest.param(("module",), id="module"),
+])
+def test_rejects_malformed_storage_ids(saved_id):
+    with pytest.raises(safe_unpickler.ForbiddenGlobal):
+        safe_unpickler.loads(build_legacy_checkpoint(saved_id))
+
+
+def test_rejects_unknown_storage_key():
+    data = build_legacy_checkpoint(("storage", torch.FloatStorage, "0", "cpu", 1, None))
+    # The list of storages after the main pickle no longer has the one the tensor uses
+    data = data.replace(pickle.dumps(["0"]), pickle.dumps([]))
+    with pytest.raises(safe_unpickler.ForbiddenGlobal):
+        safe_unpickler.loads(data)